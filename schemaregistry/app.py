@@ -8,96 +8,519 @@
     :license: BSD, see LICENSE for more details
 """
 
-from flask import Flask, request, make_response
-from flask.json import jsonify, dumps
-import storage.rocksdb
+import os
+import math
+import time
+import sys
+import atexit
+import random
+import signal
+import tempfile
+import logging
+import cProfile
+import threading
+from collections import Counter
+from flask import Flask, request, make_response, g
+from flask.json import jsonify, dumps, load, dump
 import storage.error
+import storage.timing
+from storage.timing import phase
+from ratelimit import TokenBucketLimiter
 
 app = Flask(__name__)
-_datastore = None
+app.config.from_envvar('SCHEMAREGISTRY_SETTINGS', silent=True)
+slow_request_log = logging.getLogger('schemaregistry.slow_requests')
+_datastores = dict()
+_datastores_lock = threading.Lock()
+_ready = False
+_access_counts = Counter()
+
+''' Number of bytes read from a request body at a time '''
+READ_CHUNK_SIZE = 64 * 1024
 
 def reinit_db():
-    global _datastore
-    _datastore = None
+    global _ready
+    _datastores.clear()
+    _ready = False
+    _access_counts.clear()
+    _rate_limiters.clear()
+    _concurrency_limiters.clear()
+    _rejected_counts.clear()
+
+'''
+Storage backends. Each is only imported when selected with STORAGE_BACKEND
+
+Every namespace configured in NAMESPACES has its own store, alongside the default
+namespace's store, opened with the namespace's settings.
+'''
+def _namespace_path(path, namespace):
+    return path if namespace is None else '{0}-{1}'.format(path, namespace)
+
+def _open_rocksdb(namespace, settings):
+    datapath = app.config.get('ROCKSDB_DATAFILE')
+    if datapath is None:
+        raise Exception('ROCKS_DATAFILE not set')
+
+    import storage.rocksdb
+    return storage.rocksdb.RocksDB(settings.get('datafile', _namespace_path(datapath, namespace)),
+                                   raw_ids=app.config.get('ROCKSDB_RAW_IDS', False),
+                                   block_cache_size=settings.get('block_cache_size'),
+                                   write_buffer_size=settings.get('write_buffer_size'),
+                                   chunk_size=app.config.get('ROCKSDB_CHUNK_SIZE', storage.rocksdb.CHUNK_SIZE))
+
+def _open_mmaplog(namespace, settings):
+    datapath = app.config.get('MMAPLOG_DATAFILE')
+    if datapath is None:
+        raise Exception('MMAPLOG_DATAFILE not set')
+
+    import storage.mmaplog
+    return storage.mmaplog.MMapLog(settings.get('datafile', _namespace_path(datapath, namespace)),
+                                   read_only=app.config.get('MMAPLOG_READ_ONLY', False),
+                                   zero_copy=app.config.get('MMAPLOG_ZERO_COPY', False))
+
+def _open_compactmemory(namespace, settings):
+    snapshot_file = app.config.get('COMPACTMEMORY_SNAPSHOT_FILE')
+    if snapshot_file is not None:
+        snapshot_file = settings.get('snapshot_file', _namespace_path(snapshot_file, namespace))
+
+    import storage.compactmemory
+    return storage.compactmemory.CompactMemory(snapshot_file)
+
+def _open_memory(namespace, settings):
+    import storage.memory
+    return storage.memory.Memory()
+
+_backends = {
+    'rocksdb': _open_rocksdb,
+    'mmaplog': _open_mmaplog,
+    'compactmemory': _open_compactmemory,
+    'memory': _open_memory,
+}
+
+def get_datastore(namespace=None):
+    """
+    Returns the store for a namespace, opening it if necessary.
+    Throws NamespaceDoesNotExistError if the namespace is not in NAMESPACES.
+    :param namespace: The namespace. None for the default namespace
+    """
+    datastore = _datastores.get(namespace)
+    if datastore is not None:
+        return datastore
+
+    if namespace is None:
+        settings = dict()
+    else:
+        settings = app.config.get('NAMESPACES', {}).get(namespace)
+        if settings is None:
+            raise storage.error.NamespaceDoesNotExistError()
+
+    backend = app.config.get('STORAGE_BACKEND', 'rocksdb')
+    if backend not in _backends:
+        raise Exception('Unknown STORAGE_BACKEND {0}'.format(backend))
+
+    with _datastores_lock:
+        datastore = _datastores.get(namespace)
+        if datastore is None:
+            datastore = _backends[backend](namespace, settings)
+            datastore.max_schemas = settings.get('max_schemas')
+            datastore.max_versions = settings.get('max_versions')
+            _datastores[namespace] = datastore
+
+    return datastore
+
+def record_access(name):
+    """
+    Counts a read of a schema so the most requested schemas can be warmed on startup
+    :param name: The name of the schema read
+    """
+    _access_counts[name] += 1
+
+def save_access_counts():
+    """
+    Writes the schema access counts to ACCESS_COUNTS_FILE, if set
+    """
+    filename = app.config.get('ACCESS_COUNTS_FILE')
+    if filename is None:
+        return
+
+    fd, temp_filename = tempfile.mkstemp(prefix='schemaregistry', dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, 'w') as f:
+        dump(dict(_access_counts), f)
+    os.rename(temp_filename, filename)
+
+def load_access_counts():
+    """
+    Adds the schema access counts saved in ACCESS_COUNTS_FILE, if it exists, to the current counts.
+    An unreadable file is logged and ignored.
+    """
+    filename = app.config.get('ACCESS_COUNTS_FILE')
+    if filename is None or not os.path.exists(filename):
+        return
+
+    try:
+        with open(filename) as f:
+            _access_counts.update(load(f))
+    except (IOError, ValueError, TypeError):
+        app.logger.exception('Ignoring unreadable access counts file %s', filename)
+
+def startup():
+    """
+    Opens the datastore and warms it by reading the latest version of the WARM_SCHEMA_COUNT
+    most requested schemas, and opens the datastore of every namespace in NAMESPACES. The /ready
+    endpoint reports OK once this has completed.
+
+    Deployments must call this once per process before serving requests, e.g. from the WSGI
+    entry module, and call shutdown() when the process exits. Running app.py directly does both.
+    """
+    global _ready
+    datastore = get_datastore()
+    load_access_counts()
+
+    for name, count in _access_counts.most_common(app.config.get('WARM_SCHEMA_COUNT', 0)):
+        try:
+            datastore.get_latest_schema(name)
+        except storage.error.SchemaDoesNotExistError:
+            pass
+
+    ''' Otherwise they would be opened by their first request after /ready reports OK '''
+    for namespace in app.config.get('NAMESPACES', {}):
+        get_datastore(namespace)
+
+    if app.config.get('GC_INTERVAL'):
+        _start_periodic_task('gc', app.config['GC_INTERVAL'], collect_garbage)
+
+    if app.config.get('ACCESS_COUNTS_FILE'):
+        _start_periodic_task('access-counts', app.config.get('ACCESS_COUNTS_SAVE_INTERVAL', 60), save_access_counts)
+
+    if app.config.get('STORAGE_BACKEND') == 'compactmemory' and app.config.get('COMPACTMEMORY_SNAPSHOT_FILE'):
+        _start_periodic_task('snapshot', app.config.get('COMPACTMEMORY_SNAPSHOT_INTERVAL', 60), snapshot_datastores)
+
+    if app.config.get('STORAGE_BACKEND') == 'mmaplog' and not app.config.get('MMAPLOG_READ_ONLY', False):
+        _start_periodic_task('checkpoint', app.config.get('MMAPLOG_CHECKPOINT_INTERVAL', 60), snapshot_datastores)
+
+    _ready = True
+
+def shutdown():
+    """
+    Saves state that would otherwise be lost when the process exits
+    """
+    save_access_counts()
+    snapshot_datastores()
+
+def snapshot_datastores():
+    """
+    Writes a snapshot of every open compactmemory datastore that has a snapshot file and a
+    checkpoint of every open mmaplog datastore that is not read only
+    """
+    import storage.compactmemory
+    import storage.mmaplog
+
+    for namespace, datastore in _datastores.items():
+        if isinstance(datastore, storage.compactmemory.CompactMemory) and datastore.snapshot_file is not None:
+            datastore.snapshot()
+        elif isinstance(datastore, storage.mmaplog.MMapLog) and not datastore.read_only:
+            datastore.checkpoint()
+
+def collect_garbage():
+    """
+    Calls collect_garbage on every open datastore, logging what was removed
+    """
+    for namespace, datastore in _datastores.items():
+        try:
+            removed = datastore.collect_garbage()
+        except Exception:
+            app.logger.exception('Garbage collection of namespace %s failed', namespace)
+        else:
+            if removed > 0:
+                app.logger.info('Garbage collection of namespace %s removed %d items', namespace, removed)
+
+def _start_periodic_task(name, interval, task):
+    """
+    Starts a daemon thread calling task every interval seconds, so what it saves survives a process
+    that is killed rather than allowed to exit
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                task()
+            except Exception:
+                app.logger.exception('Periodic task %s failed', name)
+
+    thread = threading.Thread(target=run, name='schemaregistry-{0}'.format(name))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+'''
+Request profiling
+
+Enabled for every request by PROFILE, or for a single request by sending an X-Profile header
+when PROFILE_HEADER is set. Profiled requests get a Server-Timing header with the time spent in
+each phase and are logged to the schemaregistry.slow_requests logger if they take longer than
+SLOW_REQUEST_THRESHOLD seconds. PROFILE_SAMPLE_RATE of profiled requests are also run under
+cProfile with the output written to PROFILE_DIR.
+'''
+def _is_profiled():
+    if app.config.get('PROFILE'):
+        return True
+
+    return app.config.get('PROFILE_HEADER', False) and 'X-Profile' in request.headers
+
+@app.before_request
+def start_profiling():
+    if not _is_profiled():
+        return
+
+    g.profile_start = time.time()
+    storage.timing.start()
+
+    if app.config.get('PROFILE_DIR') and random.random() < app.config.get('PROFILE_SAMPLE_RATE', 0):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def stop_profiling(response):
+    timer = storage.timing.stop()
+    if timer is None:
+        return response
+
+    total = time.time() - g.profile_start
+    phases = dict(timer.phases)
+    phases['other'] = total - sum(phases.itervalues())
+
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        g.profiler = None
+        filename = '{0:.6f}-{1}-{2}.prof'.format(g.profile_start, request.method, request.path.strip('/').replace('/', '_'))
+        profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], filename))
 
-def get_datastore():
-    global _datastore
-    if _datastore is None:
-        datapath = app.config.get('ROCKSDB_DATAFILE')
-        if datapath is None:
-            raise Exception('ROCKS_DATAFILE not set')
+    response.headers['Server-Timing'] = ', '.join('{0};dur={1:.3f}'.format(k, v * 1000) for k, v in sorted(phases.iteritems()))
 
-        _datastore = storage.rocksdb.RocksDB(datapath)
+    if total >= app.config.get('SLOW_REQUEST_THRESHOLD', 1.0):
+        slow_request_log.warning(dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration': total,
+            'phases': phases,
+        }))
 
-    return _datastore
+    return response
 
-@app.route('/schemas', methods=['GET'])
-def get_schemas():
+@app.teardown_request
+def discard_profiling(exception):
+    ''' after_request is skipped if the request raised '''
+    storage.timing.stop()
+
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        g.profiler = None
+
+'''
+Rate limiting and load shedding
+
+Requests are classed as write (creating or deleting), list (listing or searching schemas) or
+read (everything else). RATE_LIMITS maps a class to (rate, burst): each client, by remote address,
+may make burst requests of that class at once refilled at rate per second, further requests get 429.
+CONCURRENCY_LIMITS maps a class to the number of its requests served at once, further requests get 503.
+Classes without an entry are not limited. Rejected requests are counted by /stats.
+'''
+_route_classes = {
+    'get_schemas': 'list',
+    'create_schema': 'write',
+    'create_schema_version': 'write',
+    'delete_schema': 'write',
+    'delete_schema_version': 'write',
+}
+_rate_limiters = dict()
+_concurrency_limiters = dict()
+_limiters_lock = threading.Lock()
+_rejected_counts = Counter()
+_rejected_counts_lock = threading.Lock()
+
+def _count_rejection(route_class, reason):
+    with _rejected_counts_lock:
+        _rejected_counts['{0}.{1}'.format(route_class, reason)] += 1
+
+def _get_limiter(limiters, route_class, create):
+    limiter = limiters.get(route_class)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = limiters.get(route_class)
+            if limiter is None:
+                limiter = limiters[route_class] = create()
+
+    return limiter
+
+@app.before_request
+def limit_requests():
+    route_class = _route_classes.get(request.endpoint, 'read')
+
+    rate_limit = app.config.get('RATE_LIMITS', {}).get(route_class)
+    if rate_limit is not None:
+        limiter = _get_limiter(_rate_limiters, route_class, lambda: TokenBucketLimiter(*rate_limit))
+        wait = limiter.acquire(request.remote_addr)
+
+        if wait > 0:
+            _count_rejection(route_class, 'rate_limited')
+            retry_after = str(int(math.ceil(wait))) if wait != float('inf') else '60'
+            return 'Too many requests', 429, {'Retry-After': retry_after}
+
+    concurrency_limit = app.config.get('CONCURRENCY_LIMITS', {}).get(route_class)
+    if concurrency_limit is not None:
+        semaphore = _get_limiter(_concurrency_limiters, route_class, lambda: threading.BoundedSemaphore(concurrency_limit))
+
+        if not semaphore.acquire(False):
+            _count_rejection(route_class, 'shed')
+            return 'Overloaded', 503, {'Retry-After': '1'}
+
+        g.concurrency_semaphore = semaphore
+
+@app.teardown_request
+def release_concurrency_limit(exception):
+    semaphore = g.pop('concurrency_semaphore', None)
+    if semaphore is not None:
+        semaphore.release()
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    :return: The number of requests rejected by rate limiting (<class>.rate_limited) and load shedding (<class>.shed)
     """
-    If id set in query string then search for just that schema otherwise return all schemas
+    with _rejected_counts_lock:
+        rejected = dict(_rejected_counts)
+
+    return jsonify({'rejected': rejected}), 200
+
+@app.errorhandler(storage.error.NamespaceDoesNotExistError)
+def namespace_does_not_exist(error):
+    return 'Namespace does not exist', 404
+
+@app.errorhandler(storage.error.QuotaExceededError)
+def quota_exceeded(error):
+    return 'Quota exceeded', 403
+
+@app.errorhandler(storage.error.StoreIsReadOnlyError)
+def store_is_read_only(error):
+    return 'Store is read only', 405
+
+def schema_route(rule, **options):
+    """
+    Registers a view for rule in the default namespace and under /ns/<namespace>.
+    The view is passed the namespace, None for the default namespace.
+    """
+    def decorator(f):
+        app.add_url_rule(rule, view_func=f, defaults={'namespace': None}, **options)
+        app.add_url_rule('/ns/<namespace>' + rule, view_func=f, **options)
+        return f
+    return decorator
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    :return: 200 once startup has completed, 503 before
+    """
+    if not _ready:
+        return 'Starting', 503
+
+    return 'OK', 200
+
+@schema_route('/schemas', methods=['GET'])
+def get_schemas(namespace):
+    """
+    If id set in query string then search for just that schema. If prefix set then return schemas
+    whose names start with prefix in name order, at most limit (default and maximum SCHEMA_SEARCH_LIMIT)
+    of them. Otherwise return all schemas
 
     :return: a list of registered schema names and associated ids
     """
     id = request.args.get('id')
+    prefix = request.args.get('prefix')
 
     if id is not None:
-        schemas = get_datastore().get_schemas(ids=[id])
+        schemas = get_datastore(namespace).get_schemas(ids=[id])
+    elif prefix is not None:
+        max_limit = app.config.get('SCHEMA_SEARCH_LIMIT', 1000)
+        try:
+            limit = min(int(request.args.get('limit', max_limit)), max_limit)
+        except ValueError:
+            return 'limit must be a number', 400
+
+        if limit < 0:
+            return 'limit must not be negative', 400
+
+        schemas = get_datastore(namespace).find_schemas(prefix, limit)
     else:
-        schemas = get_datastore().get_schemas()
+        schemas = get_datastore(namespace).get_schemas()
+
+    with phase('json'):
+        body = dumps(schemas)
 
-    retval = make_response((dumps(schemas), 200, dict(mimetype='application/json')))
+    retval = make_response((body, 200, dict(mimetype='application/json')))
     return retval
 
-@app.route('/schemas/<name>', methods=['GET'])
-def get_schema_versions(name):
+@schema_route('/schemas/<name>', methods=['GET'])
+def get_schema_versions(name, namespace):
     """
     :param name: the name of the schema to search for
     :return: the list of versions of the schema available
     """
     try:
-        schema_versions = get_datastore().get_schema_versions(name)
+        schema_versions = get_datastore(namespace).get_schema_versions(name)
     except storage.error.SchemaDoesNotExistError:
         return 'Schema does not exist', 404
 
-    retval = make_response((dumps(schema_versions), 200, dict(mimetype='application/json')))
+    with phase('json'):
+        body = dumps(schema_versions)
+
+    retval = make_response((body, 200, dict(mimetype='application/json')))
     return retval
 
-@app.route('/schemas/<name>/latest', methods=['GET'])
-def get_lastest_schema(name):
+@schema_route('/schemas/<name>/latest', methods=['GET'])
+def get_lastest_schema(name, namespace):
     """
     :param name: The name of the schema to search for
     :return: The latest version of that schema
     """
     try:
-        schema = get_datastore().get_latest_schema(name)
+        schema = get_datastore(namespace).get_latest_schema(name, stream=True)
     except storage.error.SchemaDoesNotExistError:
         return 'Schema does not exist', 404
 
-    return schema, 200
+    if namespace is None:
+        record_access(name)
+
+    return app.response_class(_iter_body(schema)), 200
 
-@app.route('/schemas/<name>/<version>', methods=['GET'])
-def get_schema_version(name, version):
+@schema_route('/schemas/<name>/<version>', methods=['GET'])
+def get_schema_version(name, version, namespace):
     """
     Gets schema by name and version.
 
     If schema doesn't exist returns 404
-    If schema exists returns 200 and schema is returned as body
+    If schema exists returns 200 and schema is streamed as body
 
     :param name: The name of the schema to search for
     :param version: The version of the schema to return
     """
     try:
-        schema = get_datastore().get_schema_version(name, version)
+        schema = get_datastore(namespace).get_schema_version(name, version, stream=True)
     except storage.error.SchemaDoesNotExistError:
         return 'Schema does not exist', 404
     except storage.error.SchemaVersionDoesNotExistError:
         return 'Version does not exist', 404
 
-    return schema, 200
+    if namespace is None:
+        record_access(name)
 
+    return app.response_class(_iter_body(schema)), 200
 
-@app.route('/schemas', methods=['POST'])
-def create_schema():
+
+@schema_route('/schemas', methods=['POST'])
+def create_schema(namespace):
     """
     Creates a schema from a post request
     :return: 409 if schema already exists. 201 if schema is created with schema id in return value
@@ -107,25 +530,107 @@ def create_schema():
         return 'name not provided', 400
 
     try:
-        schema = get_datastore().create_schema(name)
+        schema = get_datastore(namespace).create_schema(name)
     except storage.error.SchemaExistsError:
         return 'Already exisits', 409
 
     return jsonify({'id': schema}), 201
 
-@app.route('/schemas/<name>', methods=['POST'])
-def create_schema_version(name):
+@schema_route('/schemas/<name>', methods=['POST'])
+def create_schema_version(name, namespace):
     """
-    Creates a schema version from a post request
-    :return: 404 if schema does not exist. 201 if schema is created with schema version in return value
+    Creates a schema version from a post request. The body is read in pieces and handed to the store
+    as it arrives, bodies longer than MAX_SCHEMA_SIZE bytes are rejected.
+    :return: 404 if schema does not exist. 413 if the body is too large. 201 if schema is created with
+    schema version in return value
     """
-    schema = request.data
+    max_size = app.config.get('MAX_SCHEMA_SIZE')
+
+    if max_size is not None and request.content_length is not None and request.content_length > max_size:
+        return 'Schema too large', 413
 
-    if not get_datastore().schema_exists(name):
+    try:
+        version = get_datastore(namespace).create_schema_version_from_stream(name, _read_chunks(request.stream, max_size))
+    except storage.error.SchemaDoesNotExistError:
         return 'Schema does not exist', 404
+    except storage.error.SchemaTooLargeError:
+        return 'Schema too large', 413
 
-    version = get_datastore().create_schema_version(name, schema)
     return jsonify({'version': version}), 201
 
+def _iter_body(chunks):
+    """
+    Yields a schema version as strings for a response. Buffers over a memory mapped store (MMAPLOG_ZERO_COPY)
+    are copied out READ_CHUNK_SIZE bytes at a time rather than all at once.
+    """
+    if chunks is None:
+        return
+
+    for chunk in chunks:
+        if isinstance(chunk, buffer):
+            for start in xrange(0, len(chunk), READ_CHUNK_SIZE):
+                yield chunk[start:start + READ_CHUNK_SIZE]
+        else:
+            yield chunk
+
+def _read_chunks(stream, max_size):
+    """
+    Reads a stream in pieces. Throws SchemaTooLargeError once more than max_size bytes have been read
+    :param stream: The stream to read
+    :param max_size: The maximum number of bytes to read. None for no limit
+    """
+    size = 0
+
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise storage.error.SchemaTooLargeError()
+
+        yield chunk
+
+def _is_permanent():
+    return request.args.get('permanent', 'false').lower() in ('true', '1')
+
+@schema_route('/schemas/<name>', methods=['DELETE'])
+def delete_schema(name, namespace):
+    """
+    Deletes a schema. If permanent=true is in the query string the schema and all its versions are removed,
+    otherwise the schema is hidden and its name cannot be reused until it is permanently deleted. Version
+    numbers are never reused, a schema created again with the same name numbers its versions on from the old one.
+    :return: 404 if schema does not exist. 204 if schema is deleted
+    """
+    try:
+        get_datastore(namespace).delete_schema(name, permanent=_is_permanent())
+    except storage.error.SchemaDoesNotExistError:
+        return 'Schema does not exist', 404
+
+    return '', 204
+
+@schema_route('/schemas/<name>/<version>', methods=['DELETE'])
+def delete_schema_version(name, version, namespace):
+    """
+    Deletes a schema version. If permanent=true is in the query string the version's body is removed too.
+    Version numbers are never reused.
+    :return: 404 if schema or version does not exist. 204 if version is deleted
+    """
+    try:
+        get_datastore(namespace).delete_schema_version(name, version, permanent=_is_permanent())
+    except storage.error.SchemaDoesNotExistError:
+        return 'Schema does not exist', 404
+    except storage.error.SchemaVersionDoesNotExistError:
+        return 'Version does not exist', 404
+
+    return '', 204
+
 if __name__ == '__main__':
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ''' Only the reloader's child process serves requests '''
+        atexit.register(shutdown)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        startup()
+
     app.run(debug=True,host= '0.0.0.0')
@@ -0,0 +1,348 @@
+"""
+    schema-registry.client
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements a client for the schema registry API
+
+    :copyright: (c) by 2016 James Moore
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import json
+import time
+import hashlib
+import httplib
+import socket
+import tempfile
+import threading
+import urllib
+import urlparse
+import Queue
+from collections import OrderedDict
+
+from storage.error import SchemaExistsError, SchemaDoesNotExistError, SchemaVersionDoesNotExistError
+
+class SchemaRegistryError(Exception):
+    """
+    Thrown when the registry returns an unexpected response
+    """
+    def __init__(self, status, body):
+        super(SchemaRegistryError, self).__init__('{0}: {1}'.format(status, body))
+        self.status = status
+        self.body = body
+
+class SchemaRegistryClient(object):
+    """
+    Client for the schema registry
+
+    Schema versions never change once created and the registry never reuses a version number for
+    a name, even after a permanent delete, so they are cached for the life of the client, in memory
+    and, if cache_dir is set, on disk. The disk cache is keyed by url as well, so clients of different
+    registries or namespaces can share a cache_dir. The latest version of a schema is cached for
+    latest_ttl seconds. Concurrent requests for the same resource share a single request to the
+    registry. Connections are kept open and reused, up to pool_size of them. A connection idle for
+    longer than idle_timeout seconds is closed rather than reused, as the registry may have closed it.
+    Set idle_timeout below the registry's keep-alive timeout.
+
+    A version deleted from the registry may still be returned from the cache of another client.
+    """
+    def __init__(self, url, pool_size=4, cache_size=1024, latest_ttl=5, cache_dir=None, timeout=10, idle_timeout=2):
+        parsed = urlparse.urlparse(url)
+        self.__connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+        self.__netloc = parsed.netloc
+        self.__base_path = parsed.path.rstrip('/')
+        self.__url = '{0}://{1}{2}'.format(parsed.scheme, parsed.netloc, self.__base_path)
+        self.__timeout = timeout
+        self.__idle_timeout = idle_timeout
+        ''' (connection, time it was last used) '''
+        self.__pool = Queue.Queue(pool_size)
+
+        self.__latest_ttl = latest_ttl
+        self.__versions = _LRUCache(cache_size)
+        self.__latest = _LRUCache(cache_size)
+        self.__cache_dir = cache_dir
+        self.__inflight = _RequestCoalescer()
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def close(self):
+        """
+        Closes all pooled connections
+        """
+        while True:
+            try:
+                self.__pool.get(block=False)[0].close()
+            except Queue.Empty:
+                return
+
+    '''
+    Registry API
+    '''
+    def get_schemas(self, id=None):
+        """
+        :param id: Optional schema id to filter on
+        :return: A list of registered schema names
+        """
+        path = '/schemas' if id is None else '/schemas?{0}'.format(urllib.urlencode({'id': id}))
+        return json.loads(self.__get(path))
+
+    def find_schemas(self, prefix, limit=None):
+        """
+        :param prefix: The start of the names to find
+        :param limit: Optional maximum number of names to return. The registry may return fewer
+        :return: The names of schemas starting with prefix in name order
+        """
+        query = {'prefix': _to_bytes(prefix)}
+        if limit is not None:
+            query['limit'] = limit
+
+        return json.loads(self.__get('/schemas?{0}'.format(urllib.urlencode(query))))
+
+    def get_schema_versions(self, name):
+        """
+        :param name: The name of the schema
+        :return: The list of versions of the schema
+        """
+        return json.loads(self.__get(self.__schema_path(name)))
+
+    def get_latest_schema(self, name):
+        """
+        :param name: The name of the schema
+        :return: The latest version of the schema
+        """
+        cached = self.__latest.get(name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        schema = self.__get(self.__schema_path(name, 'latest'))
+        self.__latest.put(name, (time.time() + self.__latest_ttl, schema))
+        return schema
+
+    def get_schema_version(self, name, version):
+        """
+        :param name: The name of the schema
+        :param version: The version of the schema
+        :return: The schema version
+        """
+        key = (name, int(version))
+
+        schema = self.__versions.get(key)
+        if schema is not None:
+            return schema
+
+        schema = self.__read_cache_file(key)
+        if schema is None:
+            schema = self.__get(self.__schema_path(name, version))
+            self.__write_cache_file(key, schema)
+
+        self.__versions.put(key, schema)
+        return schema
+
+    def create_schema(self, name):
+        """
+        :param name: The name of the schema
+        :return: The schema's id
+        """
+        body = urllib.urlencode({'name': _to_bytes(name)})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        return json.loads(self.__request('POST', '/schemas', body, headers))['id']
+
+    def create_schema_version(self, name, schema):
+        """
+        :param name: The name of the schema
+        :param schema: The new version of the schema
+        :return: The new version number
+        """
+        self.__latest.pop(name)
+        headers = {'Content-Type': 'application/octet-stream'}
+        return json.loads(self.__request('POST', self.__schema_path(name), schema, headers))['version']
+
+    def delete_schema(self, name, permanent=False):
+        """
+        :param name: The name of the schema
+        :param permanent: True to remove the schema rather than hide it
+        """
+        self.__latest.pop(name)
+        self.__request('DELETE', self.__delete_path(self.__schema_path(name), permanent))
+
+    def delete_schema_version(self, name, version, permanent=False):
+        """
+        :param name: The name of the schema
+        :param version: The version to delete
+        :param permanent: True to remove the version's body
+        """
+        self.__latest.pop(name)
+        self.__versions.pop((name, int(version)))
+        self.__request('DELETE', self.__delete_path(self.__schema_path(name, version), permanent))
+
+    '''
+    Paths
+    '''
+    def __schema_path(self, name, *parts):
+        return '/'.join(['/schemas'] + [urllib.quote(_to_bytes(p), safe='') for p in (name,) + parts])
+
+    def __delete_path(self, path, permanent):
+        return '{0}?permanent=true'.format(path) if permanent else path
+
+    '''
+    On disk cache
+    '''
+    def __cache_filename(self, key):
+        name, version = key
+        digest = hashlib.sha256(b'{0}\0{1}'.format(self.__url, _to_bytes(name))).hexdigest()
+        return os.path.join(self.__cache_dir, '{0}.{1}'.format(digest, version))
+
+    def __read_cache_file(self, key):
+        if self.__cache_dir is None:
+            return None
+
+        try:
+            with open(self.__cache_filename(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def __write_cache_file(self, key, schema):
+        if self.__cache_dir is None:
+            return
+
+        fd, temp_name = tempfile.mkstemp(prefix='schemaregistry', dir=self.__cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(schema)
+        os.rename(temp_name, self.__cache_filename(key))
+
+    '''
+    HTTP
+    '''
+    def __get(self, path):
+        return self.__inflight.run(path, lambda: self.__request('GET', path))
+
+    def __request(self, method, path, body=None, headers={}):
+        status, data = self.__send(method, path, body, headers)
+
+        if status in (200, 201, 204):
+            return data
+        if status == 404 and data == 'Schema does not exist':
+            raise SchemaDoesNotExistError()
+        if status == 404 and data == 'Version does not exist':
+            raise SchemaVersionDoesNotExistError()
+        if status == 409:
+            raise SchemaExistsError()
+
+        raise SchemaRegistryError(status, data)
+
+    def __send(self, method, path, body, headers):
+        """
+        Sends a request on a pooled connection. A GET or DELETE that fails on a reused connection is
+        retried once on a new one as the registry may have closed the idle connection.
+        """
+        connection = self.__get_pooled_connection()
+        reused = connection is not None
+
+        if connection is None:
+            connection = self.__connection_class(self.__netloc, timeout=self.__timeout)
+
+        try:
+            connection.request(method, self.__base_path + path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused or method == 'POST':
+                raise
+            return self.__send(method, path, body, headers)
+
+        try:
+            self.__pool.put((connection, time.time()), block=False)
+        except Queue.Full:
+            connection.close()
+
+        return response.status, data
+
+    def __get_pooled_connection(self):
+        """
+        :return: A pooled connection that has not been idle for longer than idle_timeout, None if there are none
+        """
+        while True:
+            try:
+                connection, last_used = self.__pool.get(block=False)
+            except Queue.Empty:
+                return None
+
+            if time.time() - last_used <= self.__idle_timeout:
+                return connection
+
+            connection.close()
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+class _LRUCache(object):
+    """
+    Thread safe least recently used cache
+    """
+    def __init__(self, size):
+        self.__size = size
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            value = self.__items.pop(key, None)
+            if value is not None:
+                self.__items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = value
+            if len(self.__items) > self.__size:
+                self.__items.popitem(last=False)
+
+    def pop(self, key):
+        with self.__lock:
+            self.__items.pop(key, None)
+
+class _RequestCoalescer(object):
+    """
+    Runs a function once for all callers asking for the same key at the same time
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = dict()
+
+    def run(self, key, function):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+        return call.result
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,52 @@
+"""
+    schema-registry.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements per client token bucket rate limiting
+
+    :copyright: (c) by 2016 James Moore
+    :license: BSD, see LICENSE for more details
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+class TokenBucketLimiter(object):
+    """
+    Gives each client a bucket of burst tokens refilled at rate tokens per second.
+    Each request takes a token. Only the max_clients most recently seen clients are
+    remembered, a forgotten client starts again with a full bucket.
+    """
+    def __init__(self, rate, burst, max_clients=10000):
+        self.__rate = float(rate)
+        self.__burst = float(burst)
+        self.__max_clients = max_clients
+        self.__buckets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def acquire(self, client):
+        """
+        Takes a token from a client's bucket
+        :param client: The client's identifier
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available
+        """
+        now = time.time()
+
+        with self.__lock:
+            tokens, last = self.__buckets.pop(client, (self.__burst, now))
+            tokens = min(self.__burst, tokens + (now - last) * self.__rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            elif self.__rate > 0:
+                wait = (1 - tokens) / self.__rate
+            else:
+                wait = float('inf')
+
+            self.__buckets[client] = (tokens, now)
+            if len(self.__buckets) > self.__max_clients:
+                self.__buckets.popitem(last=False)
+
+        return wait
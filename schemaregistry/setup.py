@@ -3,6 +3,7 @@ setup(
     name = "SchemaRegistry",
     version = "0.1",
     packages = find_packages(exclude=["tests"]),
+    py_modules = ['client', 'ratelimit'],
     scripts = ['app.py'],
 
     # Project uses reStructuredText, so ensure that the docutils get
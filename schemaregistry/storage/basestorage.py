@@ -9,69 +9,94 @@
 """
 
 import hashlib
-from error import SchemaExistsError, SchemaDoesNotExistError, SchemaHasNoVersionsError, SchemaVersionDoesNotExistError
+import threading
+from timing import phase
+from error import SchemaExistsError, SchemaDoesNotExistError, SchemaHasNoVersionsError, SchemaVersionDoesNotExistError, \
+    QuotaExceededError
+
+''' Maximum number of name => id mappings remembered by _name_to_id '''
+ID_CACHE_SIZE = 4096
 
 class BaseStorage(object):
     """
     Base object providing default implementations for storage subclasses
     """
+    ''' name => id, shared by all storage objects as the mapping does not depend on the store '''
+    _id_cache = dict()
+
+    ''' Limits on the number of schemas in the store and versions of each schema. None for no limit '''
+    max_schemas = None
+    max_versions = None
+
+    def __init__(self):
+        ''' Makes checking the schema quota and creating or deleting a schema atomic '''
+        self.__schema_lock = threading.Lock()
+        ''' Number of schemas that have not been permanently deleted. Counted when the schema quota is first checked '''
+        self.__schema_count = None
+        ''' id => lock making checking the version quota and creating a version atomic '''
+        self.__version_locks = dict()
+
     '''
     Default implementations
     '''
     def get_schemas(self, ids = []):
         """
-        Returns a list of known schemas
+        Returns a list of known schemas. Deleted schemas are not included.
         :param ids: Optional parameter specifying list of ids to filter on
         :return: A list of schema names
         """
         return [self._id_to_name(k) for k in self._do_get_schema_ids() if len(ids) == 0 or k in ids]
 
+    def find_schemas(self, prefix, limit=None):
+        """
+        Returns the names of schemas starting with prefix in name order. Deleted schemas are not included.
+        :param prefix: The start of the names to find
+        :param limit: Optional maximum number of names to return
+        :return: A list of schema names
+        """
+        return self._do_find_schema_names(prefix, limit)
+
     def get_schema_versions(self, name):
         """
-        Returns the list of known versions for a schema
+        Returns the list of known versions for a schema. Deleted versions are not included.
         :param name: The name of the schema
         :return: List of versions
         """
-        id = self._name_to_id(name)
-        schema = self._get_schema_by_id(id)
-
-        if schema is None:
-            raise SchemaDoesNotExistError()
-
-        return self._get_schema_versions(schema)
+        schema = self._get_live_schema(name)
+        return self._get_live_versions(schema)
 
-    def get_schema_version(self, name, version):
+    def get_schema_version(self, name, version, stream=False):
         """
         Given a schema name and version returns that schema version. Throws SchemaDoesNotExist if schema does not exist.
 
         :param name: The name of the schema
         :param version: The version of the schema
+        :param stream: True to return the schema version as an iterator of strings
         :return: None if schema version does not exist. Otherwise the schema version.
         """
-        id = self._name_to_id(name)
-        schema = self._get_schema_by_id(id)
+        schema = self._get_live_schema(name)
 
-        if schema is None:
-            raise SchemaDoesNotExistError()
+        if self.__is_version_deleted(schema, version):
+            raise SchemaVersionDoesNotExistError()
 
-        version = self._get_version(schema, version)
+        if stream:
+            version = self._get_version_chunks(schema, version)
+        else:
+            version = self._get_version(schema, version)
 
         if version is None:
             raise SchemaVersionDoesNotExistError()
 
         return version
 
-    def get_latest_schema(self, name):
+    def get_latest_schema(self, name, stream=False):
         """
         Returns the latest version of a schema
         :param name: the schema name
+        :param stream: True to return the schema version as an iterator of strings
         :return: the latest version of the schema
         """
-        id = self._name_to_id(name)
-        schema = self._get_schema_by_id(id)
-
-        if schema is None:
-            raise SchemaDoesNotExistError()
+        schema = self._get_live_schema(name)
 
         try:
             version_number = self._get_schema_latest_version_number(schema)
@@ -79,43 +104,174 @@ class BaseStorage(object):
             ''' No schema versions '''
             return None
 
-        return self.get_schema_version(name, version_number)
+        if stream:
+            return self._get_version_chunks(schema, version_number)
+
+        return self._get_version(schema, version_number)
 
     def create_schema(self, name):
         """
-        Creates a schema. Throws SchemaExistsError if schema already exists
+        Creates a schema. Throws SchemaExistsError if schema already exists, including
+        if it has been deleted but not permanently. Throws QuotaExceededError if the store
+        already has max_schemas schemas, counting deleted schemas until they are permanently deleted.
         :param name: The name of the schema
         :returns: The schema's id
         """
-        if self.schema_exists(name):
-            raise SchemaExistsError()
-
         id = self._name_to_id(name)
-        self._do_create_schema(name, id)
+
+        with self.__schema_lock:
+            if self._get_schema_by_id(id) is not None:
+                raise SchemaExistsError()
+
+            if self.max_schemas is not None:
+                if self.__schema_count is None:
+                    self.__schema_count = self._count_schemas()
+
+                if self.__schema_count >= self.max_schemas:
+                    raise QuotaExceededError()
+
+            self._do_create_schema(name, id)
+
+            if self.__schema_count is not None:
+                self.__schema_count += 1
+
         return id
 
     def schema_exists(self, name):
         """
         Checks if a schema exists
         :param name: The name of the schema
-        :return: True if schema exists, false otherwise
+        :return: True if schema exists and has not been deleted, false otherwise
         """
         id = self._name_to_id(name)
-        return self._get_schema_by_id(id) is not None
+        schema = self._get_schema_by_id(id)
+        return schema is not None and not self._is_schema_deleted(schema)
 
     def create_schema_version(self, name, new_schema):
         """
-        Creates a new version of a schema
+        Creates a new version of a schema. Throws QuotaExceededError if the schema already
+        has max_versions versions, including deleted versions.
         :param name: the name of the schema
         :param new_schema: the new version of the schema
         :return: the new version number
         """
-        if not self.schema_exists(name):
-            raise SchemaDoesNotExistError()
+        with self.__version_lock(name):
+            schema = self.__get_schema_for_new_version(name)
+            return self._do_create_schema_version(schema, new_schema)
+
+    def create_schema_version_from_stream(self, name, chunks):
+        """
+        Creates a new version of a schema from a stream. Stores able to write large versions
+        piece by piece do so without holding the whole version in memory.
+        :param name: the name of the schema
+        :param chunks: iterable of strings making up the new version
+        :return: the new version number
+        """
+        with self.__version_lock(name):
+            schema = self.__get_schema_for_new_version(name)
+            return self._do_create_schema_version_from_chunks(schema, chunks)
+
+    def __version_lock(self, name):
+        """
+        :return: A lock on the schema's versions if there is a version quota to check, otherwise a no-op
+        """
+        if self.max_versions is None:
+            return _NO_LOCK
+
+        return self.__version_locks.setdefault(self._name_to_id(name), threading.Lock())
+
+    def __get_schema_for_new_version(self, name):
+        schema = self._get_live_schema(name)
+
+        if self.max_versions is not None and len(self._get_schema_versions(schema)) >= self.max_versions:
+            raise QuotaExceededError()
+
+        return schema
+
+    def delete_schema(self, name, permanent=False):
+        """
+        Deletes a schema. A deleted schema is hidden but its name cannot be reused until it is
+        permanently deleted, which removes it and all of its versions. Version numbers are not reused,
+        a schema created again with the same name numbers its versions on from the deleted schema's.
+        Throws SchemaDoesNotExistError if schema does not exist.
+        :param name: The name of the schema
+        :param permanent: True to remove the schema rather than hide it. Allowed on deleted schemas.
+        """
+        id = self._name_to_id(name)
+
+        with self.__schema_lock:
+            schema = self._get_schema_by_id(id)
+            if schema is None:
+                raise SchemaDoesNotExistError()
+
+            if not permanent and self._is_schema_deleted(schema):
+                raise SchemaDoesNotExistError()
+
+            self._do_delete_schema(schema, permanent)
+
+            if self.__schema_count is not None and permanent:
+                self.__schema_count -= 1
+
+    def delete_schema_version(self, name, version, permanent=False):
+        """
+        Deletes a schema version. Version numbers are never reused, so a deleted version is
+        hidden and a permanently deleted version also has its body removed.
+        Throws SchemaDoesNotExistError if schema does not exist and SchemaVersionDoesNotExistError
+        if the version does not exist.
+        :param name: The name of the schema
+        :param version: The version to delete
+        :param permanent: True to remove the version's body. Allowed on deleted versions.
+        """
+        schema = self._get_live_schema(name)
+
+        try:
+            version = int(version)
+        except ValueError:
+            raise SchemaVersionDoesNotExistError()
+
+        if version not in self._get_schema_versions(schema):
+            raise SchemaVersionDoesNotExistError()
+
+        if not permanent and self.__is_version_deleted(schema, version):
+            raise SchemaVersionDoesNotExistError()
+
+        self._do_delete_schema_version(schema, version, permanent)
+
+    def collect_garbage(self):
+        """
+        Removes data no longer reachable from any schema, e.g. left behind by a crash part way through a write
+        :return: The number of items removed
+        """
+        return self._do_collect_garbage()
 
+    def _get_live_schema(self, name):
+        """
+        Returns a schema that has not been deleted. Throws SchemaDoesNotExistError otherwise.
+        :param name: The name of the schema
+        :return: The schema
+        """
         id = self._name_to_id(name)
         schema = self._get_schema_by_id(id)
-        return self._do_create_schema_version(schema, new_schema)
+
+        if schema is None or self._is_schema_deleted(schema):
+            raise SchemaDoesNotExistError()
+
+        return schema
+
+    def _get_live_versions(self, schema):
+        """
+        Returns the versions of a schema that have not been deleted
+        :param schema: The schema
+        :return: List of versions
+        """
+        deleted = self._get_deleted_versions(schema)
+        return [v for v in self._get_schema_versions(schema) if v not in deleted]
+
+    def __is_version_deleted(self, schema, version):
+        try:
+            return int(version) in self._get_deleted_versions(schema)
+        except ValueError:
+            return False
 
     def _get_schema_latest_version_number(self, schema):
         """
@@ -123,7 +279,7 @@ class BaseStorage(object):
         :param schema: The name of the schema
         :return: The latest version number
         """
-        versions = self._get_schema_versions(schema)
+        versions = self._get_live_versions(schema)
 
         try:
             return max(versions)
@@ -136,7 +292,22 @@ class BaseStorage(object):
         :param name: The name of the schema
         :return: the schema's id
         """
-        return hashlib.sha256(name).hexdigest()
+        id = self._id_cache.get(name)
+
+        if id is None:
+            with phase('name_to_id'):
+                id = hashlib.sha256(name).hexdigest()
+
+            if len(self._id_cache) >= ID_CACHE_SIZE:
+                try:
+                    self._id_cache.popitem()
+                except KeyError:
+                    ''' Emptied by another thread '''
+                    pass
+
+            self._id_cache[name] = id
+
+        return id
 
     '''
     Abstract methods
@@ -168,11 +339,18 @@ class BaseStorage(object):
 
     def _do_get_schema_ids(self):
         """
-        Returns a list of schema ids
+        Returns a list of schema ids, excluding deleted schemas
         :return: list containing schema ids
         """
         pass
 
+    def _count_schemas(self):
+        """
+        Returns the number of schemas, including deleted schemas that have not been permanently deleted
+        :return: The number of schemas
+        """
+        pass
+
     def _do_create_schema(self, name, id):
         """
         Creates a new schema
@@ -198,3 +376,83 @@ class BaseStorage(object):
         """
         pass
 
+    def _is_schema_deleted(self, schema):
+        """
+        Checks if a schema has been deleted
+        :param schema: The schema
+        :return: True if the schema has been deleted but not permanently
+        """
+        pass
+
+    def _get_deleted_versions(self, schema):
+        """
+        Returns the deleted versions of a schema
+        :param schema: The schema
+        :return: A set of deleted version numbers
+        """
+        pass
+
+    def _do_delete_schema(self, schema, permanent):
+        """
+        Deletes a schema
+        :param schema: The schema
+        :param permanent: True to remove the schema and its versions, False to mark it deleted
+        """
+        pass
+
+    def _do_delete_schema_version(self, schema, version, permanent):
+        """
+        Marks a schema version deleted
+        :param schema: The schema
+        :param version: The version number
+        :param permanent: True to also remove the version's body
+        """
+        pass
+
+    def _do_collect_garbage(self):
+        """
+        Removes unreachable data
+        :return: The number of items removed
+        """
+        return 0
+
+    def _do_create_schema_version_from_chunks(self, schema, chunks):
+        """
+        Creates a new schema version from a stream. Stores able to write large versions in
+        pieces should override this.
+        :param schema: The schema
+        :param chunks: iterable of strings making up the new version
+        :return: The new version number
+        """
+        return self._do_create_schema_version(schema, b''.join(chunks))
+
+    def _get_version_chunks(self, schema, version):
+        """
+        Returns a schema version as an iterator of strings. Stores holding large versions in
+        pieces should override this.
+        :param schema: The schema
+        :param version: The version required
+        :return: An iterator over the schema version or None if schema version doesn't exist
+        """
+        body = self._get_version(schema, version)
+        return iter([body]) if body is not None else None
+
+    def _do_find_schema_names(self, prefix, limit):
+        """
+        Returns the names of schemas starting with prefix in name order, excluding deleted schemas.
+        Stores keeping their names in order should override this rather than list every schema.
+        :param prefix: The start of the names to find
+        :param limit: Maximum number of names to return. None for no limit
+        :return: A list of schema names
+        """
+        names = sorted(n for n in self.get_schemas() if n.startswith(prefix))
+        return names if limit is None else names[:limit]
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NO_LOCK = _NoLock()
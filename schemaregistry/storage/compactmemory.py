@@ -0,0 +1,235 @@
+"""
+    compactmemory.py
+    ~~~~~~~~~~~~~~~~
+
+    This module implements a compact, thread safe in memory storage module
+    suitable for use as a cache tier.
+
+    :copyright: (c) by 2016 James Moore
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import sys
+import bisect
+import binascii
+import pickle
+import tempfile
+import threading
+
+from basestorage import BaseStorage
+from error import SchemaDoesNotExistError
+
+class CompactMemory(BaseStorage):
+    """
+    Implementation of storage mechanism that keeps everything in memory, laid out to
+    minimise per schema and per version overhead
+
+    Storage as follows:
+        key: raw 32 byte digest of the id => _Subject(name, [version base + 1 body, version base + 2 body, ...],
+            deleted, deleted versions, base)
+
+        a permanently deleted version keeps its place in the list with its body replaced by None
+
+        version numbers are not reused when a name is recreated after a permanent delete, the last
+        version number used is remembered and becomes the new schema's base
+
+        the hex id used by BaseStorage is only materialised when listing schemas
+
+        names of schemas that are not deleted are also kept in a sorted list for find_schemas
+
+    If snapshot_file is given the contents are loaded from it on creation (if it
+    exists) and can be written back to it with snapshot().
+    """
+    def __init__(self, snapshot_file=None):
+        super(CompactMemory, self).__init__()
+        self.__snapshot_file = snapshot_file
+        self.__lock = threading.Lock()
+        self.__subjects = dict()
+        self.__sorted_names = list()
+        ''' raw key => last version number used by permanently deleted schemas with that key '''
+        self.__version_bases = dict()
+
+        if snapshot_file is not None and os.path.exists(snapshot_file):
+            self.__load(snapshot_file)
+
+    @property
+    def snapshot_file(self):
+        """
+        The file given on creation, None if there is none
+        """
+        return self.__snapshot_file
+
+    def __to_key(self, id):
+        try:
+            return binascii.unhexlify(id)
+        except (TypeError, binascii.Error):
+            return None
+
+    def __load(self, snapshot_file):
+        with open(snapshot_file, 'rb') as f:
+            entries, self.__version_bases = pickle.load(f)
+
+        for entry in entries:
+            subject = _Subject(*entry)
+            self.__subjects[self.__to_key(self._name_to_id(subject.name))] = subject
+
+            if not subject.deleted:
+                self.__sorted_names.append(subject.name)
+
+        self.__sorted_names.sort()
+
+    def snapshot(self, snapshot_file=None):
+        """
+        Writes the contents of the store to a snapshot file. The file is replaced atomically.
+        :param snapshot_file: The file to write to. Defaults to the file given on creation
+        """
+        snapshot_file = snapshot_file or self.__snapshot_file
+        if snapshot_file is None:
+            raise ValueError('snapshot_file not set')
+
+        with self.__lock:
+            entries = [(s.name, list(s.versions), s.deleted, s.deleted_versions, s.base) for s in self.__subjects.itervalues()]
+            version_bases = dict(self.__version_bases)
+
+        fd, temp_name = tempfile.mkstemp(prefix='schemaregistry', dir=os.path.dirname(os.path.abspath(snapshot_file)))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((entries, version_bases), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_name, snapshot_file)
+
+    def memory_footprint(self):
+        """
+        Estimates the memory used by the store
+        :return: dict containing the number of schemas and versions and the estimated size in bytes
+            of the index (keys, records and version lists) and of the schema bodies
+        """
+        with self.__lock:
+            subjects = self.__subjects.items()
+
+        index_bytes = sys.getsizeof(self.__subjects) + sys.getsizeof(self.__sorted_names)
+        body_bytes = 0
+        versions = 0
+        seen = set()
+
+        for key, subject in subjects:
+            index_bytes += sys.getsizeof(key) + sys.getsizeof(subject) + sys.getsizeof(subject.name)
+            index_bytes += sys.getsizeof(subject.versions)
+            versions += len(subject.versions)
+
+            for body in subject.versions:
+                if body is not None and id(body) not in seen:
+                    seen.add(id(body))
+                    body_bytes += sys.getsizeof(body)
+
+        return {
+            'schemas': len(subjects),
+            'versions': versions,
+            'index_bytes': index_bytes,
+            'body_bytes': body_bytes,
+        }
+
+    def __check_subject(self, schema):
+        """
+        Throws SchemaDoesNotExistError if the subject has been permanently deleted. Must hold self.__lock
+        """
+        if self.__subjects.get(self.__to_key(self._name_to_id(schema.name))) is not schema:
+            raise SchemaDoesNotExistError()
+
+    def _get_schema_by_id(self, id):
+        return self.__subjects.get(self.__to_key(id))
+
+    def _get_version(self, schema, version):
+        try:
+            index = int(version) - 1 - schema.base
+        except ValueError:
+            return None
+
+        if index < 0 or index >= len(schema.versions):
+            return None
+
+        return schema.versions[index]
+
+    def _id_to_name(self, id):
+        subject = self.__subjects.get(self.__to_key(id))
+        return subject.name if subject is not None else None
+
+    def _do_get_schema_ids(self):
+        with self.__lock:
+            return [binascii.hexlify(k) for k, s in self.__subjects.iteritems() if not s.deleted]
+
+    def _count_schemas(self):
+        with self.__lock:
+            return len(self.__subjects)
+
+    def _get_schema_versions(self, schema):
+        return range(schema.base + 1, schema.base + len(schema.versions) + 1)
+
+    def _do_create_schema(self, name, id):
+        with self.__lock:
+            key = self.__to_key(id)
+            if key not in self.__subjects:
+                self.__subjects[key] = _Subject(name, [], base=self.__version_bases.get(key, 0))
+                bisect.insort(self.__sorted_names, name)
+
+    def _do_create_schema_version(self, schema, new_version):
+        with self.__lock:
+            self.__check_subject(schema)
+            schema.versions.append(new_version)
+            return schema.base + len(schema.versions)
+
+    def _is_schema_deleted(self, schema):
+        return schema.deleted
+
+    def _get_deleted_versions(self, schema):
+        return schema.deleted_versions or frozenset()
+
+    def _do_find_schema_names(self, prefix, limit):
+        with self.__lock:
+            names = self.__sorted_names
+            retval = list()
+
+            for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+                if not names[i].startswith(prefix) or (limit is not None and len(retval) >= limit):
+                    break
+
+                retval.append(names[i])
+
+            return retval
+
+    def _do_delete_schema(self, schema, permanent):
+        with self.__lock:
+            self.__check_subject(schema)
+            if not schema.deleted:
+                del self.__sorted_names[bisect.bisect_left(self.__sorted_names, schema.name)]
+
+            if permanent:
+                key = self.__to_key(self._name_to_id(schema.name))
+                self.__version_bases[key] = schema.base + len(schema.versions)
+                del self.__subjects[key]
+            else:
+                schema.deleted = True
+
+    def _do_delete_schema_version(self, schema, version, permanent):
+        with self.__lock:
+            self.__check_subject(schema)
+            if schema.deleted_versions is None:
+                schema.deleted_versions = set()
+
+            schema.deleted_versions.add(version)
+
+            if permanent:
+                schema.versions[version - 1 - schema.base] = None
+
+class _Subject(object):
+    """
+    A schema and its versions. Version n is held at index n - base - 1.
+    deleted_versions is None until a version is deleted
+    """
+    __slots__ = ('name', 'versions', 'deleted', 'deleted_versions', 'base')
+
+    def __init__(self, name, versions, deleted=False, deleted_versions=None, base=0):
+        self.name = name
+        self.versions = versions
+        self.deleted = deleted
+        self.deleted_versions = deleted_versions
+        self.base = base
@@ -30,4 +30,40 @@ class SchemaVersionDoesNotExistError(Exception):
     """
     Thrown when a schema version does not exist
     """
+    pass
+
+class KeyFormatMismatchError(Exception):
+    """
+    Thrown when a store is opened with a different key format to the one it was created with
+    """
+    pass
+
+class QuotaExceededError(Exception):
+    """
+    Thrown when creating a schema or schema version would exceed the store's quota
+    """
+    pass
+
+class NamespaceDoesNotExistError(Exception):
+    """
+    Thrown when a namespace has not been configured
+    """
+    pass
+
+class SchemaTooLargeError(Exception):
+    """
+    Thrown when a schema version is larger than allowed
+    """
+    pass
+
+class SchemaVersionCorruptError(Exception):
+    """
+    Thrown when a stored schema version does not match its recorded length or checksum
+    """
+    pass
+
+class StoreIsReadOnlyError(IOError):
+    """
+    Thrown when writing to a store opened read only
+    """
     pass
\ No newline at end of file
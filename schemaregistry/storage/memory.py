@@ -10,39 +10,106 @@
     :license: BSD, see LICENSE for more details
 """
 
+import bisect
 from basestorage import BaseStorage
+from error import SchemaDoesNotExistError
 
 class Memory(BaseStorage):
     """
     Implementation of storage mechanism that keeps everything in memory
     """
     def __init__(self):
+        super(Memory, self).__init__()
         self.__data = dict()
+        ''' id => last version number used by permanently deleted schemas with that id '''
+        self.__version_bases = dict()
         self.__reverse_map = dict()
+        self.__deleted = set()
+        self.__deleted_versions = dict()
+        self.__sorted_names = list()
 
     def _get_schema_by_id(self, id):
-        return self.__data.get(id)
+        return id if id in self.__data else None
 
     def _get_version(self, schema, version):
-        return schema.get(version)
+        try:
+            return self.__data[schema].get(int(version))
+        except ValueError:
+            return None
 
     def _id_to_name(self, id):
         return self.__reverse_map.get(id)
 
     def _do_get_schema_ids(self):
-        return [k for k in self.__data]
+        return [k for k in self.__data if k not in self.__deleted]
+
+    def _count_schemas(self):
+        return len(self.__data)
 
     def _get_schema_versions(self, schema):
-        return [k for k in schema]
+        return [k for k in self.__data[schema]]
 
     def _do_create_schema(self, name, id):
         self.__data[id] = dict()
         self.__reverse_map[id] = name
+        self.__deleted_versions[id] = set()
+        bisect.insort(self.__sorted_names, name)
 
     def _do_create_schema_version(self, schema, new_version):
-        new_version_number = self.__get_next_schema_version(schema)
-        schema[new_version_number] = new_version
+        self.__check_schema_exists(schema)
+        versions = self.__data[schema]
+        new_version_number = self.__get_next_schema_version(schema, versions)
+        versions[new_version_number] = new_version
         return new_version_number
 
-    def __get_next_schema_version(self, schema):
-        return len(schema) + 1
\ No newline at end of file
+    def __get_next_schema_version(self, schema, versions):
+        return self.__version_bases.get(schema, 0) + len(versions) + 1
+
+    def _is_schema_deleted(self, schema):
+        return schema in self.__deleted
+
+    def _get_deleted_versions(self, schema):
+        return self.__deleted_versions[schema]
+
+    def _do_find_schema_names(self, prefix, limit):
+        names = self.__sorted_names
+        retval = list()
+
+        for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix) or (limit is not None and len(retval) >= limit):
+                break
+
+            retval.append(names[i])
+
+        return retval
+
+    def _do_delete_schema(self, schema, permanent):
+        self.__check_schema_exists(schema)
+        if schema not in self.__deleted:
+            self.__remove_sorted_name(self.__reverse_map[schema])
+
+        if permanent:
+            self.__version_bases[schema] = self.__version_bases.get(schema, 0) + len(self.__data[schema])
+            del self.__data[schema]
+            del self.__reverse_map[schema]
+            del self.__deleted_versions[schema]
+            self.__deleted.discard(schema)
+        else:
+            self.__deleted.add(schema)
+
+    def _do_delete_schema_version(self, schema, version, permanent):
+        self.__check_schema_exists(schema)
+        self.__deleted_versions[schema].add(version)
+        if permanent:
+            ''' Keep the entry so the version number is not reused '''
+            self.__data[schema][version] = None
+
+    def __check_schema_exists(self, schema):
+        """
+        Throws SchemaDoesNotExistError if the schema has been permanently deleted
+        """
+        if schema not in self.__data:
+            raise SchemaDoesNotExistError()
+
+    def __remove_sorted_name(self, name):
+        del self.__sorted_names[bisect.bisect_left(self.__sorted_names, name)]
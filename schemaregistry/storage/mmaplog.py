@@ -0,0 +1,348 @@
+"""
+    mmaplog.py
+    ~~~~~~~~~~
+
+    This module implements an append-only, memory mapped log file storage module
+
+    :copyright: (c) by 2016 James Moore
+    :license: BSD, see LICENSE for more details
+"""
+
+import os
+import mmap
+import pickle
+import struct
+import tempfile
+import threading
+import zlib
+
+from basestorage import BaseStorage
+from error import SchemaDoesNotExistError, StoreIsReadOnlyError
+
+class MMapLog(BaseStorage):
+    """
+    Implementation of storage mechanism that appends everything to a single log file
+
+    Storage as follows:
+        each record is a header followed by a key and a value
+        header: struct '>BIII' => record type, crc32 of key + value, key length, value length
+
+        record type RECORD_SCHEMA:          key: id => value: name
+        record type RECORD_VERSION:         key: id => value: schema body
+        record type RECORD_DELETE_SCHEMA:   key: id => value: DELETE_PERMANENT or empty
+        record type RECORD_DELETE_VERSION:  key: id => value: struct '>I' version followed by DELETE_PERMANENT or nothing
+
+    Versions of a schema are numbered by the order their records appear in the log. Numbering of a
+    schema recreated after a permanent delete carries on from the last version of the deleted schema.
+
+    Deletes only update the index. Space used by deleted schemas and versions stays in the log.
+    Records for a schema that has been permanently deleted are skipped when the log is scanned.
+
+    The index (id => name, id => list of (offset, length) of version bodies) is held in
+    memory and rebuilt by scanning the log when the file is opened. A torn record at the
+    tail of the log (e.g. from a crash part way through an append) is discarded and,
+    unless opened read only, truncated from the file.
+
+    checkpoint() writes the index, and the offset of the end of the log it covers, to
+    datafile_name + '.checkpoint'. It is called by close(). When the log is opened the
+    checkpoint is loaded, if it still matches the log, and only records after it are scanned.
+
+    Schema bodies are read straight out of the memory mapped log. If zero_copy is set
+    they are returned as read only buffer slices of the mapping rather than copied into
+    a new string.
+    """
+    RECORD_SCHEMA = 1
+    RECORD_VERSION = 2
+    RECORD_DELETE_SCHEMA = 3
+    RECORD_DELETE_VERSION = 4
+
+    DELETE_PERMANENT = b'p'
+
+    HEADER = struct.Struct('>BIII')
+    VERSION = struct.Struct('>I')
+
+    def __init__(self, datafile_name, read_only=False, zero_copy=False):
+        super(MMapLog, self).__init__()
+        self.__datafile_name = datafile_name
+        self.__read_only = read_only
+        self.__zero_copy = zero_copy
+        self.__lock = threading.Lock()
+
+        self.__names = dict()
+        self.__versions = dict()
+        self.__deleted = set()
+        self.__deleted_versions = dict()
+        ''' id => last version number used by permanently deleted schemas with that id '''
+        self.__version_bases = dict()
+        ''' Offset of the start of the last record in the log '''
+        self.__last_record = 0
+
+        if not read_only and not os.path.exists(datafile_name):
+            open(datafile_name, 'ab').close()
+
+        self.__file = open(datafile_name, 'rb' if read_only else 'r+b')
+        self.__map = None
+        self.__map_size = 0
+
+        self.__remap()
+        end = self.__recover(self.__load_checkpoint())
+
+        if end < self.__map_size and not read_only:
+            self.__file.truncate(end)
+            self.__remap()
+
+        self.__end = end
+
+    @property
+    def read_only(self):
+        """
+        True if the log was opened read only
+        """
+        return self.__read_only
+
+    def close(self):
+        """
+        Writes a checkpoint, unless opened read only, and closes the memory mapping and the log file
+        """
+        if not self.__read_only:
+            self.checkpoint()
+
+        self.__map = None
+        self.__map_size = 0
+        self.__file.close()
+
+    def __remap(self):
+        size = os.fstat(self.__file.fileno()).st_size
+        if size == 0:
+            self.__map = None
+        else:
+            self.__map = mmap.mmap(self.__file.fileno(), size, access=mmap.ACCESS_READ)
+        self.__map_size = size
+
+    def checkpoint(self):
+        """
+        Writes the index to the checkpoint file so the log need not be scanned when next opened.
+        The file is replaced atomically.
+        """
+        with self.__lock:
+            state = (self.__end, self.__last_record, self.__names, dict((k, list(v)) for k, v in self.__versions.iteritems()),
+                     set(self.__deleted), dict((k, set(v)) for k, v in self.__deleted_versions.iteritems()),
+                     self.__version_bases)
+            data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+        checkpoint_file = self.__get_checkpoint_filename()
+        fd, temp_name = tempfile.mkstemp(prefix='schemaregistry', dir=os.path.dirname(os.path.abspath(checkpoint_file)))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_name, checkpoint_file)
+
+    def __get_checkpoint_filename(self):
+        return '{0}.checkpoint'.format(self.__datafile_name)
+
+    def __load_checkpoint(self):
+        """
+        Loads the index from the checkpoint file if it matches the log, i.e. the last record it
+        covers is intact and ends where the checkpoint does
+        :return: The offset the checkpoint covers the log up to, 0 if there is no usable checkpoint
+        """
+        try:
+            with open(self.__get_checkpoint_filename(), 'rb') as f:
+                state = pickle.load(f)
+            end, last_record, names, versions, deleted, deleted_versions, version_bases = state
+        except Exception:
+            ''' Missing or unreadable, the whole log is scanned instead '''
+            return 0
+
+        if end == 0 or self.__read_record(last_record) != end:
+            return 0
+
+        self.__last_record = last_record
+        self.__names = names
+        self.__versions = versions
+        self.__deleted = deleted
+        self.__deleted_versions = deleted_versions
+        self.__version_bases = version_bases
+        return end
+
+    def __read_record(self, offset):
+        """
+        Checks the record at offset is complete and its crc matches
+        :return: The offset of the end of the record, None if it is not intact
+        """
+        header_size = self.HEADER.size
+        if offset + header_size > self.__map_size:
+            return None
+
+        type, crc, key_length, value_length = self.HEADER.unpack_from(self.__map, offset)
+        key_start = offset + header_size
+        end = key_start + key_length + value_length
+
+        if end > self.__map_size:
+            return None
+
+        ''' A buffer over the mapping avoids copying every record just to check it '''
+        if zlib.crc32(buffer(self.__map, key_start, end - key_start)) & 0xffffffff != crc:
+            return None
+
+        return end
+
+    def __recover(self, offset):
+        """
+        Scans the log from offset rebuilding the index
+        :param offset: The offset of the first record not in the index
+        :return: The offset of the end of the last complete record
+        """
+        header_size = self.HEADER.size
+
+        while True:
+            end = self.__read_record(offset)
+            if end is None:
+                break
+
+            type, crc, key_length, value_length = self.HEADER.unpack_from(self.__map, offset)
+            key_start = offset + header_size
+            value_start = key_start + key_length
+            id = self.__map[key_start:value_start]
+
+            if type == self.RECORD_SCHEMA:
+                self.__index_schema(id, self.__map[value_start:end].decode('utf-8'))
+            elif id not in self.__versions:
+                ''' Written by a write racing a permanent delete of the schema '''
+                pass
+            elif type == self.RECORD_VERSION:
+                self.__versions[id].append((value_start, value_length))
+            elif type == self.RECORD_DELETE_SCHEMA:
+                self.__index_delete_schema(id, self.__map[value_start:end] == self.DELETE_PERMANENT)
+            elif type == self.RECORD_DELETE_VERSION:
+                version = self.VERSION.unpack_from(self.__map, value_start)[0]
+                permanent = self.__map[value_start + self.VERSION.size:end] == self.DELETE_PERMANENT
+                self.__index_delete_version(id, version, permanent)
+
+            self.__last_record = offset
+            offset = end
+
+        return offset
+
+    def __index_schema(self, id, name):
+        self.__names[id] = name
+        self.__versions[id] = list()
+        self.__deleted_versions[id] = set()
+        self.__deleted.discard(id)
+
+    def __index_delete_schema(self, id, permanent):
+        if permanent:
+            self.__version_bases[id] = self.__version_bases.get(id, 0) + len(self.__versions[id])
+            del self.__names[id]
+            del self.__versions[id]
+            del self.__deleted_versions[id]
+            self.__deleted.discard(id)
+        else:
+            self.__deleted.add(id)
+
+    def __index_delete_version(self, id, version, permanent):
+        self.__deleted_versions[id].add(version)
+        if permanent:
+            self.__versions[id][version - 1 - self.__version_bases.get(id, 0)] = None
+
+    def __append(self, type, key, value):
+        """
+        Appends a record to the end of the log
+        :return: The offset of the record's value
+        """
+        if self.__read_only:
+            raise StoreIsReadOnlyError('{0} is opened read only'.format(self.__datafile_name))
+
+        crc = zlib.crc32(key + value) & 0xffffffff
+        header = self.HEADER.pack(type, crc, len(key), len(value))
+
+        self.__file.seek(self.__end)
+        self.__file.write(header + key + value)
+        self.__file.flush()
+        self.__last_record = self.__end
+
+        value_offset = self.__end + len(header) + len(key)
+        self.__end = value_offset + len(value)
+        return value_offset
+
+    def __check_schema_exists(self, schema):
+        """
+        Throws SchemaDoesNotExistError if the schema has been permanently deleted. Must hold self.__lock
+        """
+        if schema not in self.__versions:
+            raise SchemaDoesNotExistError()
+
+    def __read(self, offset, length):
+        if offset + length > self.__map_size:
+            self.__remap()
+
+        if self.__zero_copy:
+            return buffer(self.__map, offset, length)
+
+        return self.__map[offset:offset + length]
+
+    def _get_schema_by_id(self, id):
+        return id if id in self.__versions else None
+
+    def _get_version(self, schema, version):
+        version_list = self.__versions[schema]
+        try:
+            index = int(version) - 1 - self.__version_bases.get(schema, 0)
+        except ValueError:
+            return None
+
+        if index < 0 or index >= len(version_list):
+            return None
+
+        if version_list[index] is None:
+            return None
+
+        offset, length = version_list[index]
+        return self.__read(offset, length)
+
+    def _id_to_name(self, id):
+        return self.__names.get(id)
+
+    def _do_get_schema_ids(self):
+        return [k for k in self.__names if k not in self.__deleted]
+
+    def _count_schemas(self):
+        return len(self.__names)
+
+    def _get_schema_versions(self, schema):
+        base = self.__version_bases.get(schema, 0)
+        return range(base + 1, base + len(self.__versions[schema]) + 1)
+
+    def _do_create_schema(self, name, id):
+        with self.__lock:
+            self.__append(self.RECORD_SCHEMA, id, name.encode('utf-8'))
+            self.__index_schema(id, name)
+
+    def _do_create_schema_version(self, schema, new_version):
+        if isinstance(new_version, unicode):
+            new_version = new_version.encode('utf-8')
+
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            offset = self.__append(self.RECORD_VERSION, schema, new_version)
+            version_list = self.__versions[schema]
+            version_list.append((offset, len(new_version)))
+            return self.__version_bases.get(schema, 0) + len(version_list)
+
+    def _is_schema_deleted(self, schema):
+        return schema in self.__deleted
+
+    def _get_deleted_versions(self, schema):
+        return self.__deleted_versions[schema]
+
+    def _do_delete_schema(self, schema, permanent):
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            self.__append(self.RECORD_DELETE_SCHEMA, schema, self.DELETE_PERMANENT if permanent else b'')
+            self.__index_delete_schema(schema, permanent)
+
+    def _do_delete_schema_version(self, schema, version, permanent):
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            value = self.VERSION.pack(version) + (self.DELETE_PERMANENT if permanent else b'')
+            self.__append(self.RECORD_DELETE_VERSION, schema, value)
+            self.__index_delete_version(schema, version, permanent)
@@ -10,12 +10,31 @@
 from __future__ import absolute_import
 import os
 import gc
+import binascii
+import hashlib
 import pickle
 import rocksdb
 import shutil
+import struct
 import tempfile
+import threading
+import zlib
+from itertools import groupby, chain
 
 from .basestorage import BaseStorage
+from .error import KeyFormatMismatchError, SchemaDoesNotExistError, SchemaVersionDoesNotExistError, \
+    SchemaVersionCorruptError
+from .timing import phase
+
+KEY_FORMAT_HEX = b'hex'
+KEY_FORMAT_RAW = b'raw'
+
+''' Schema versions larger than this are stored in chunks of this size '''
+CHUNK_SIZE = 1024 * 1024
+
+''' First byte of a chunked schema version's manifest. Never the first byte of a pickle '''
+CHUNKED_MARKER = b'\x00'
+CHUNK_MANIFEST = struct.Struct('>IQ')
 
 class RocksDB(BaseStorage):
     """
@@ -29,41 +48,256 @@ class RocksDB(BaseStorage):
 
         key: %s.%s => schema_object
 
+        schema versions longer than chunk_size bytes are split into chunks instead:
+        key: %s.%s => CHUNKED_MARKER, CHUNK_MANIFEST (number of chunks, length), sha256 hex digest of schema
+        key: %s.%s.%08d => zlib compressed chunk
+
+        key: %s.deleted % id => name, present if schema is deleted. The schema's reverse key is removed.
+        key: %s.deleted_versions % id => serialised list of deleted version numbers
+        key: %s.version_base % id => last version number used by permanently deleted schemas with this id.
+            Numbering of the schema's versions carries on from it, version n is at index n - base - 1.
+
+        key: %s, self.__format_key => KEY_FORMAT_HEX or KEY_FORMAT_RAW
+
+        key: %s.%s, self.__name_prefix, utf-8 name => empty, present unless schema is deleted.
+            Orders schemas by name for find_schemas. Built on open for stores created before it existed,
+            self.__name_index_key is set once it has been.
+
         id is used as a handle for schema
 
+        If raw_ids is set the 32 byte sha256 digest is used as id in keys rather than its 64 character
+        hex form. The id then fills the whole StaticPrefix, so every key of a schema shares one prefix.
+        A store created with hex ids can be converted with migrate_to_raw_ids().
+
+        block_cache_size and write_buffer_size, in bytes, override rocksdb's defaults if set.
+
+        Permanently deleting a schema removes every key starting with its id and then compacts that range.
+        collect_garbage() removes schema_objects no version metadata refers to and compacts the ranges of the ids it removed them from.
     """
-    def __init__(self, datafile_name):
+    def __init__(self, datafile_name, raw_ids=False, block_cache_size=None, write_buffer_size=None, chunk_size=CHUNK_SIZE):
+        super(RocksDB, self).__init__()
         self.__datafile_name = datafile_name
+        self.__chunk_size = chunk_size
+        self.__pending_version_keys = set()
         self.__reverse_prefix = b'_reverse______________________32'
+        self.__format_key = b'_format_______________________32'
+        self.__name_prefix = b'_names________________________32'
+        self.__name_index_key = b'_nameindex____________________32'
+        self.__raw_ids = raw_ids
+        self.__lock = threading.Lock()
 
         opts = rocksdb.Options()
         opts.create_if_missing=True
         opts.prefix_extractor = StaticPrefix()
         opts.merge_operator = VersionMerger()
+
+        if block_cache_size is not None:
+            opts.table_factory = rocksdb.BlockBasedTableFactory(block_cache=rocksdb.LRUCache(block_cache_size))
+
+        if write_buffer_size is not None:
+            opts.write_buffer_size = write_buffer_size
+
         self.__db = rocksdb.DB(self.__datafile_name, opts)
 
+        self.__check_key_format()
+        self.__check_name_index()
+
+    def __check_key_format(self):
+        stored_format = self.__db.get(self.__format_key)
+
+        if stored_format is None:
+            ''' Stores written before the format key existed use hex ids '''
+            if len(self._do_get_schema_ids()) > 0:
+                stored_format = KEY_FORMAT_HEX
+            else:
+                stored_format = KEY_FORMAT_RAW if self.__raw_ids else KEY_FORMAT_HEX
+                self.__db.put(self.__format_key, stored_format)
+
+        if stored_format != (KEY_FORMAT_RAW if self.__raw_ids else KEY_FORMAT_HEX):
+            raise KeyFormatMismatchError('{0} uses {1} ids'.format(self.__datafile_name, stored_format))
+
+    def __check_name_index(self):
+        if self.__db.get(self.__name_index_key) is not None:
+            return
+
+        batch = rocksdb.WriteBatch()
+
+        for key, name in self.__iter_prefix(self.__reverse_prefix):
+            batch.put(self.__get_name_key(name), b'')
+
+        batch.put(self.__name_index_key, b'')
+        self.__db.write(batch)
+
+    def __iter_prefix(self, prefix):
+        iterator = self.__db.iteritems()
+        iterator.seek(prefix)
+
+        for key, value in iterator:
+            if not key.startswith(prefix):
+                break
+
+            yield key, value
+
+    def __is_metadata_key(self, key):
+        """
+        True for keys not belonging to a single schema id
+        """
+        return key in (self.__format_key, self.__name_index_key) or key.startswith(self.__reverse_prefix) \
+            or key.startswith(self.__name_prefix)
+
+    def migrate_to_raw_ids(self):
+        """
+        Rewrites every key of a store using hex ids to use raw ids in a single batch.
+        Afterwards the store must be opened with raw_ids set.
+        """
+        if self.__raw_ids:
+            return
+
+        batch = rocksdb.WriteBatch()
+        iterator = self.__db.iteritems()
+        iterator.seek_to_first()
+
+        for key, value in iterator:
+            if key.startswith(self.__reverse_prefix):
+                new_key = self.__get_reverse_key(binascii.unhexlify(key[33:]))
+            elif self.__is_metadata_key(key):
+                continue
+            else:
+                new_key = binascii.unhexlify(key[:64]) + key[64:]
+
+                if key.endswith(b'.info'):
+                    version_list = pickle.loads(value)
+                    value = pickle.dumps([binascii.unhexlify(k[:64]) + k[64:] for k in version_list])
+
+            batch.put(new_key, value)
+            batch.delete(key)
+
+        batch.put(self.__format_key, KEY_FORMAT_RAW)
+        self.__db.write(batch)
+        self.__raw_ids = True
+
+    def __to_key_id(self, id):
+        if not self.__raw_ids:
+            return id
+
+        try:
+            return binascii.unhexlify(id)
+        except (TypeError, binascii.Error):
+            return None
+
+    def __from_key_id(self, key_id):
+        return binascii.hexlify(key_id) if self.__raw_ids else key_id
+
+    def __get(self, key):
+        with phase('rocksdb_get'):
+            return self.__db.get(key)
+
+    def __loads(self, bytes):
+        with phase('unpickle'):
+            return pickle.loads(bytes)
+
     def __get_info_key(self, id):
         return b'{0}.info'.format(id)
 
+    def __get_deleted_key(self, id):
+        return b'{0}.deleted'.format(id)
+
+    def __get_deleted_versions_key(self, id):
+        return b'{0}.deleted_versions'.format(id)
+
+    def __get_version_base_key(self, id):
+        return b'{0}.version_base'.format(id)
+
+    def __get_version_base(self, schema):
+        bytes = self.__get(self.__get_version_base_key(schema))
+        return int(bytes) if bytes is not None else 0
+
+    def __is_version_key(self, key):
+        return len(key) > self.__id_length() + 1 and key[self.__id_length() + 1:] not in (b'info', b'deleted', b'deleted_versions', b'version_base')
+
+    def __id_length(self):
+        return 32 if self.__raw_ids else 64
+
+    def __new_version_key(self, schema):
+        return b'{0}.{1}'.format(schema, os.urandom(24).encode('base-64').replace('\n', ''))
+
+    def __get_version_key_of(self, key):
+        """
+        :return: The version key a version or chunk key belongs to
+        """
+        return key[:self.__id_length() + 33]
+
+    def __get_chunk_key(self, version_key, index):
+        return b'{0}.{1:08d}'.format(version_key, index)
+
+    def __iter_chunks(self, version_key, manifest):
+        """
+        Yields the chunks of a chunked version, checking them against the manifest. The last chunk is only
+        yielded once the length and digest match, otherwise SchemaVersionCorruptError is thrown.
+        Throws SchemaVersionDoesNotExistError if a chunk has gone, e.g. the version was deleted while being read.
+        """
+        count, length = CHUNK_MANIFEST.unpack_from(manifest, len(CHUNKED_MARKER))
+        expected_digest = manifest[len(CHUNKED_MARKER) + CHUNK_MANIFEST.size:]
+        digest = hashlib.sha256()
+        read = 0
+
+        for index in xrange(count):
+            bytes = self.__get(self.__get_chunk_key(version_key, index))
+            if bytes is None:
+                raise SchemaVersionDoesNotExistError()
+
+            try:
+                chunk = zlib.decompress(bytes)
+            except zlib.error:
+                raise SchemaVersionCorruptError()
+
+            digest.update(chunk)
+            read += len(chunk)
+
+            if index == count - 1 and (read != length or digest.hexdigest() != expected_digest):
+                raise SchemaVersionCorruptError()
+
+            yield chunk
+
     def __get_reverse_key(self, id):
         return b'{0}.{1}'.format(self.__reverse_prefix, id)
 
+    def __get_name_key(self, name):
+        """
+        :param name: The utf-8 encoded name
+        """
+        return b'{0}.{1}'.format(self.__name_prefix, name)
+
     def __get_temp_filename(self):
         return tempfile.mkdtemp(prefix='schemaregistry')
 
     def _get_schema_by_id(self, id):
-        info_key = self.__get_info_key(id)
-        return id if self.__db.get(info_key) is not None else None
+        key_id = self.__to_key_id(id)
+        if key_id is None:
+            return None
+
+        info_key = self.__get_info_key(key_id)
+        return key_id if self.__get(info_key) is not None else None
+
+    def __check_schema_exists(self, schema):
+        """
+        Throws SchemaDoesNotExistError if the schema has been permanently deleted. Must hold self.__lock
+        """
+        if self.__db.get(self.__get_info_key(schema)) is None:
+            raise SchemaDoesNotExistError()
 
     def __get_version_list(self, schema):
         info_key = self.__get_info_key(schema)
-        bytes = self.__db.get(info_key)
-        return pickle.loads(bytes)
+        bytes = self.__get(info_key)
+        return self.__loads(bytes)
 
-    def _get_version(self, schema, version):
+    def __get_version_value(self, schema, version):
+        """
+        :return: The version key and its stored value, or None if the version does not exist
+        """
         version_list = self.__get_version_list(schema)
         try:
-            index = int(version) - 1
+            index = int(version) - 1 - self.__get_version_base(schema)
         except ValueError:
             return None
 
@@ -71,12 +305,34 @@ class RocksDB(BaseStorage):
             return None
 
         version_key = version_list[index]
-        bytes = self.__db.get(version_key)
-        return pickle.loads(bytes)
+        bytes = self.__get(version_key)
+        return (version_key, bytes) if bytes is not None else None
+
+    def _get_version(self, schema, version):
+        found = self.__get_version_value(schema, version)
+        if found is None:
+            return None
+
+        version_key, bytes = found
+        if bytes.startswith(CHUNKED_MARKER):
+            return b''.join(self.__iter_chunks(version_key, bytes))
+
+        return self.__loads(bytes)
+
+    def _get_version_chunks(self, schema, version):
+        found = self.__get_version_value(schema, version)
+        if found is None:
+            return None
+
+        version_key, bytes = found
+        if bytes.startswith(CHUNKED_MARKER):
+            return self.__iter_chunks(version_key, bytes)
+
+        return iter([self.__loads(bytes)])
 
     def _id_to_name(self, id):
-        key_name = self.__get_reverse_key(id)
-        name = self.__db.get(key_name)
+        key_name = self.__get_reverse_key(self.__to_key_id(id))
+        name = self.__get(key_name)
         return name.decode('utf-8')
 
     def _do_get_schema_ids(self):
@@ -90,31 +346,225 @@ class RocksDB(BaseStorage):
             if not id.startswith(prefix):
                 break
 
-            retval.append(id[33:])
+            retval.append(self.__from_key_id(id[33:]))
 
         return retval
 
+    def _count_schemas(self):
+        ''' Deleted schemas have no reverse key so this counts info keys, reading every key in the store '''
+        iterator = self.__db.iterkeys()
+        iterator.seek_to_first()
+        return sum(1 for k in iterator if k.endswith(b'.info') and not self.__is_metadata_key(k))
+
     def _get_schema_versions(self, schema):
         version_list = self.__get_version_list(schema)
-        return range(1, len(version_list) + 1)
+        base = self.__get_version_base(schema)
+        return range(base + 1, base + len(version_list) + 1)
+
+    def _do_find_schema_names(self, prefix, limit):
+        start = self.__get_name_key(prefix.encode('utf-8'))
+        offset = len(self.__name_prefix) + 1
+
+        retval = list()
+
+        for key, value in self.__iter_prefix(start):
+            if limit is not None and len(retval) >= limit:
+                break
+
+            retval.append(key[offset:].decode('utf-8'))
+
+        return retval
 
     def _do_create_schema(self, name, id):
-        reverse_key = self.__get_reverse_key(id)
-        info_key = self.__get_info_key(id)
-        self.__db.put(reverse_key, name.encode('utf-8'))
-        self.__db.put(info_key, pickle.dumps(list()))
+        key_id = self.__to_key_id(id)
+        reverse_key = self.__get_reverse_key(key_id)
+        info_key = self.__get_info_key(key_id)
+        encoded_name = name.encode('utf-8')
+
+        batch = rocksdb.WriteBatch()
+        batch.put(reverse_key, encoded_name)
+        batch.put(self.__get_name_key(encoded_name), b'')
+        batch.put(info_key, pickle.dumps(list()))
+        self.__db.write(batch)
 
     def _do_create_schema_version(self, schema, new_version):
-        version_key = b'{0}.{1}'.format(schema, os.urandom(24).encode('base-64').replace('\n', ''))
+        if isinstance(new_version, str) and len(new_version) > self.__chunk_size:
+            return self._do_create_schema_version_from_chunks(schema, [new_version])
+
+        version_key = self.__new_version_key(schema)
         info_key = self.__get_info_key(schema)
 
-        self.__db.merge(info_key, pickle.dumps([version_key]))
-        self.__db.put(version_key, pickle.dumps(new_version))
+        ''' Written before the metadata refers to it so a crash leaves an unreferenced object for collect_garbage '''
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            self.__db.put(version_key, pickle.dumps(new_version))
+            self.__db.merge(info_key, pickle.dumps([version_key]))
+
+        listbytes = self.__get(info_key)
+        list = self.__loads(listbytes)
+
+        return self.__get_version_base(schema) + list.index(version_key) + 1
+
+    def _do_create_schema_version_from_chunks(self, schema, chunks):
+        pieces = _rechunk(chunks, self.__chunk_size)
+        first = next(pieces, b'')
+        second = next(pieces, None)
+
+        if second is None:
+            return self._do_create_schema_version(schema, first)
+
+        version_key = self.__new_version_key(schema)
+        info_key = self.__get_info_key(schema)
+        digest = hashlib.sha256()
+        count = 0
+        length = 0
+
+        ''' Chunks are written without holding the lock, collect_garbage leaves them alone until the version is added '''
+        with self.__lock:
+            self.__pending_version_keys.add(version_key)
+
+        try:
+            for piece in chain([first, second], pieces):
+                digest.update(piece)
+                self.__db.put(self.__get_chunk_key(version_key, count), zlib.compress(piece))
+                count += 1
+                length += len(piece)
+
+            manifest = CHUNKED_MARKER + CHUNK_MANIFEST.pack(count, length) + digest.hexdigest()
+
+            with self.__lock:
+                self.__check_schema_exists(schema)
+                self.__db.put(version_key, manifest)
+                self.__db.merge(info_key, pickle.dumps([version_key]))
+        except:
+            ''' e.g. the stream was too large or the client went away, remove the chunks written so far '''
+            batch = rocksdb.WriteBatch()
+            for index in xrange(count):
+                batch.delete(self.__get_chunk_key(version_key, index))
+            self.__db.write(batch)
+            raise
+        finally:
+            with self.__lock:
+                self.__pending_version_keys.discard(version_key)
+
+        listbytes = self.__get(info_key)
+        list = self.__loads(listbytes)
+
+        return self.__get_version_base(schema) + list.index(version_key) + 1
+
+    def _is_schema_deleted(self, schema):
+        return self.__get(self.__get_deleted_key(schema)) is not None
+
+    def _get_deleted_versions(self, schema):
+        bytes = self.__get(self.__get_deleted_versions_key(schema))
+        return set(self.__loads(bytes)) if bytes is not None else frozenset()
+
+    def _do_delete_schema(self, schema, permanent):
+        reverse_key = self.__get_reverse_key(schema)
+        batch = rocksdb.WriteBatch()
+
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            name = self.__db.get(reverse_key)
+            if name is not None:
+                batch.delete(self.__get_name_key(name))
+
+            if permanent:
+                start = b'{0}.'.format(schema)
+                iterator = self.__db.iterkeys()
+                iterator.seek(start)
+
+                for key in iterator:
+                    if not key.startswith(start):
+                        break
+
+                    batch.delete(key)
+
+                ''' Applied after the deletes above so the new value is kept '''
+                base = self.__get_version_base(schema) + len(self.__get_version_list(schema))
+                batch.put(self.__get_version_base_key(schema), str(base))
+            else:
+                batch.put(self.__get_deleted_key(schema), name)
+
+            batch.delete(reverse_key)
+            self.__db.write(batch)
+
+        if permanent:
+            self.__db.compact_range(begin=b'{0}.'.format(schema), end=b'{0}/'.format(schema))
+
+    def _do_delete_schema_version(self, schema, version, permanent):
+        batch = rocksdb.WriteBatch()
+        batch.merge(self.__get_deleted_versions_key(schema), pickle.dumps([version]))
+
+        with self.__lock:
+            self.__check_schema_exists(schema)
+            if permanent:
+                version_key = self.__get_version_list(schema)[version - 1 - self.__get_version_base(schema)]
+                batch.delete(version_key)
+
+                for key, value in self.__iter_prefix(b'{0}.'.format(version_key)):
+                    batch.delete(key)
+
+            self.__db.write(batch)
+
+    def _do_collect_garbage(self):
+        id_length = self.__id_length()
+        iterator = self.__db.iterkeys()
+        iterator.seek_to_first()
+
+        removed = 0
+        touched_ids = list()
+        version_keys = (k for k in iterator if not self.__is_metadata_key(k) and self.__is_version_key(k))
+
+        for id, keys in groupby(version_keys, lambda k: k[:id_length]):
+            keys = list(keys)
+            batch = rocksdb.WriteBatch()
+
+            with self.__lock:
+                if self.__db.get(self.__get_info_key(id)) is None:
+                    referenced = set()
+                else:
+                    referenced = set(self.__get_version_list(id))
+
+                referenced.update(self.__pending_version_keys)
+                unreferenced = [k for k in keys if self.__get_version_key_of(k) not in referenced]
+                for key in unreferenced:
+                    batch.delete(key)
+
+                if len(unreferenced) > 0:
+                    self.__db.write(batch)
+
+            removed += len(unreferenced)
+            if len(unreferenced) > 0:
+                touched_ids.append(id)
+
+        for id in touched_ids:
+            self.__db.compact_range(begin=b'{0}.'.format(id), end=b'{0}/'.format(id))
+
+        return removed
+
+def _rechunk(chunks, size):
+    """
+    Regroups an iterable of strings into strings of size bytes, the last may be shorter
+    """
+    buffered = list()
+    buffered_length = 0
+
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_length += len(chunk)
+
+        if buffered_length >= size:
+            data = b''.join(buffered)
+            for start in xrange(0, len(data) - size + 1, size):
+                yield data[start:start + size]
 
-        listbytes = self.__db.get(info_key)
-        list = pickle.loads(listbytes)
+            remainder = data[len(data) - len(data) % size:]
+            buffered = [remainder]
+            buffered_length = len(remainder)
 
-        return list.index(version_key) + 1
+    if buffered_length > 0:
+        yield b''.join(buffered)
 
 class VersionMerger(rocksdb.interfaces.AssociativeMergeOperator):
     def merge(self, key, existing_value, value):
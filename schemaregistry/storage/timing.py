@@ -0,0 +1,86 @@
+"""
+    timing.py
+    ~~~~~~~~~
+
+    This module implements per thread timing of named phases of a request.
+
+    Code marks a phase with `with phase('name'):`. Nothing is recorded unless a
+    timer has been started on the current thread with start().
+
+    :copyright: (c) by 2016 James Moore
+    :license: BSD, see LICENSE for more details
+"""
+
+import time
+import threading
+
+_local = threading.local()
+
+def start():
+    """
+    Starts recording phases on the current thread
+    :return: The timer
+    """
+    timer = _local.timer = Timer()
+    return timer
+
+def stop():
+    """
+    Stops recording phases on the current thread
+    :return: The timer, or None if none was started
+    """
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    return timer
+
+def phase(name):
+    """
+    :param name: The name of the phase
+    :return: A context manager timing the phase if a timer is running on the current thread
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return _NO_PHASE
+
+    return _Phase(timer, name)
+
+class Timer(object):
+    """
+    Total time spent in each phase. Time spent in a phase nested in another
+    is only counted against the inner phase.
+    """
+    def __init__(self):
+        self.phases = dict()
+        self.stack = list()
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'start', 'nested')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.timer.stack.append(self)
+        self.start = time.time()
+
+    def __exit__(self, type, value, traceback):
+        elapsed = time.time() - self.start
+        stack = self.timer.stack
+        stack.pop()
+
+        if stack:
+            stack[-1].nested += elapsed
+
+        phases = self.timer.phases
+        phases[self.name] = phases.get(self.name, 0.0) + elapsed - self.nested
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NO_PHASE = _NoPhase()
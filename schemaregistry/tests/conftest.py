@@ -1,10 +1,12 @@
 from schemaregistry.storage.memory import Memory
 from schemaregistry.storage.rocksdb import RocksDB
+from schemaregistry.storage.mmaplog import MMapLog
+from schemaregistry.storage.compactmemory import CompactMemory
 import pytest
 
 def pytest_generate_tests(metafunc):
     if 'storageengine' in metafunc.fixturenames:
-        metafunc.parametrize("storageengine", ['memory', 'rocksdb'], indirect=True)
+        metafunc.parametrize("storageengine", ['memory', 'rocksdb', 'rocksdb_raw', 'mmaplog', 'compactmemory'], indirect=True)
 
 
 @pytest.fixture
@@ -13,3 +15,9 @@ def storageengine(request, tmpdir_factory):
         return Memory()
     elif request.param == 'rocksdb':
         return RocksDB(str(tmpdir_factory.mktemp('schemaregistry', numbered=True)))
+    elif request.param == 'rocksdb_raw':
+        return RocksDB(str(tmpdir_factory.mktemp('schemaregistry', numbered=True)), raw_ids=True)
+    elif request.param == 'mmaplog':
+        return MMapLog(str(tmpdir_factory.mktemp('schemaregistry', numbered=True).join('schemas.log')))
+    elif request.param == 'compactmemory':
+        return CompactMemory()
@@ -7,10 +7,14 @@
     :copyright: (c) 2016 by James Moore.
     :license: BSD, see LICENSE for more details.
 """
+import os
+import sys
 import json
+import time
 import pytest
 
-from app import app, reinit_db
+import app as app_module
+from app import app, reinit_db, startup, shutdown, save_access_counts
 
 '''
 HELPER FUNCTIONS
@@ -202,3 +206,320 @@ def test_get_non_existant_version(schemas,versions,get_url, response):
         assert resp.status_code == response['status_code']
         assert resp.data == response['data']
 
+
+'''
+GET /ready
+'''
+@pytest.fixture()
+def access_counts_file(tmpdir):
+    app.config['ACCESS_COUNTS_FILE'] = str(tmpdir.join('access_counts.json'))
+    app.config['WARM_SCHEMA_COUNT'] = 1
+    yield app.config['ACCESS_COUNTS_FILE']
+    app.config.pop('ACCESS_COUNTS_FILE')
+    app.config.pop('WARM_SCHEMA_COUNT')
+
+@pytest.mark.usefixtures("emptydb")
+def test_ready_after_startup():
+    with app.test_client() as c:
+        assert c.get('/ready').status_code == 503
+        startup()
+        resp = c.get('/ready')
+        assert resp.status_code == 200
+        assert resp.data == 'OK'
+
+@pytest.mark.usefixtures("emptydb")
+def test_access_counts_survive_restart(access_counts_file):
+    with app.test_client() as c:
+        create_schema(c, 'test')
+        create_schema(c, 'test2')
+        create_version(c, 'test', 'v1')
+        create_version(c, 'test2', 'v1')
+
+        c.get('/schemas/test/latest')
+        c.get('/schemas/test/1')
+        c.get('/schemas/test2/latest')
+        c.get('/schemas/non_existant/latest')
+        save_access_counts()
+
+    reinit_db()
+    startup()
+    save_access_counts()
+
+    with open(access_counts_file) as f:
+        assert json.load(f) == {'test': 2, 'test2': 1}
+
+@pytest.mark.usefixtures("emptydb")
+def test_unreadable_access_counts_are_ignored(access_counts_file):
+    with open(access_counts_file, 'w') as f:
+        f.write('{"test": ')
+
+    startup()
+    with app.test_client() as c:
+        assert c.get('/ready').status_code == 200
+
+@pytest.mark.usefixtures("emptydb")
+def test_access_counts_are_saved_periodically(access_counts_file):
+    app.config['ACCESS_COUNTS_SAVE_INTERVAL'] = 0.05
+    try:
+        startup()
+        with app.test_client() as c:
+            create_schema(c, 'test')
+            create_version(c, 'test', 'v1')
+            c.get('/schemas/test/latest')
+
+        time.sleep(0.2)
+        with open(access_counts_file) as f:
+            assert json.load(f)['test'] >= 1
+    finally:
+        app.config.pop('ACCESS_COUNTS_SAVE_INTERVAL')
+
+@pytest.mark.usefixtures("emptydb")
+def test_compactmemory_is_snapshotted_on_shutdown(tmpdir):
+    app.config['STORAGE_BACKEND'] = 'compactmemory'
+    app.config['COMPACTMEMORY_SNAPSHOT_FILE'] = str(tmpdir.join('schemas.snapshot'))
+    try:
+        with app.test_client() as c:
+            create_schema(c, 'test')
+            create_version(c, 'test', 'v1')
+
+        shutdown()
+        reinit_db()
+
+        with app.test_client() as c:
+            assert c.get('/schemas/test/latest').data == 'v1'
+    finally:
+        app.config.pop('STORAGE_BACKEND')
+        app.config.pop('COMPACTMEMORY_SNAPSHOT_FILE')
+
+@pytest.fixture()
+def mmaplog(tmpdir):
+    app.config['STORAGE_BACKEND'] = 'mmaplog'
+    app.config['MMAPLOG_DATAFILE'] = str(tmpdir.join('schemas.log'))
+    app.config['MMAPLOG_ZERO_COPY'] = True
+    reinit_db()
+    yield
+    app.config.pop('STORAGE_BACKEND')
+    app.config.pop('MMAPLOG_DATAFILE')
+    app.config.pop('MMAPLOG_ZERO_COPY')
+    app.config.pop('MMAPLOG_READ_ONLY', None)
+
+@pytest.mark.usefixtures("mmaplog")
+def test_mmaplog_zero_copy_and_read_only():
+    with app.test_client() as c:
+        create_schema(c, 'test')
+        create_version(c, 'test', 'v1')
+        assert c.get('/schemas/test/latest').data == 'v1'
+        assert c.get('/schemas/test/1').data == 'v1'
+
+    shutdown()
+    app.config['MMAPLOG_READ_ONLY'] = True
+    reinit_db()
+
+    with app.test_client() as c:
+        assert c.get('/schemas/test/1').data == 'v1'
+        resp = c.post('/schemas/test', data='v2')
+        assert resp.status_code == 405
+        assert resp.data == 'Store is read only'
+
+'''
+DELETE /schemas/<name>
+DELETE /schemas/<name>/<version>
+'''
+test_delete_test_params = [
+    ([],        [],           '/schemas/non_existant',          404, '/schemas/non_existant', 404),
+    (['test'],  [],           '/schemas/test',                  204, '/schemas/test',         404),
+    (['test'],  ['v1'],       '/schemas/test?permanent=true',   204, '/schemas/test',         404),
+    (['test'],  ['v1'],       '/schemas/test/2',                404, '/schemas/test/1',       200),
+    (['test'],  ['v1', 'v2'], '/schemas/test/2',                204, '/schemas/test/latest',  200),
+    (['test'],  ['v1', 'v2'], '/schemas/test/1?permanent=true', 204, '/schemas/test/1',       404),
+]
+
+@pytest.mark.usefixtures("emptydb")
+@pytest.mark.parametrize("schemas,versions,delete_url,delete_status_code,get_url,get_status_code", test_delete_test_params)
+def test_delete(schemas, versions, delete_url, delete_status_code, get_url, get_status_code):
+    with app.test_client() as c:
+        for schema in schemas:
+            create_schema(c, schema)
+
+            for version in versions:
+                create_version(c, schema, version)
+
+        assert c.delete(delete_url).status_code == delete_status_code
+        assert c.get(get_url).status_code == get_status_code
+
+'''
+Request profiling
+'''
+@pytest.fixture()
+def profiling(tmpdir):
+    app.config['PROFILE_HEADER'] = True
+    app.config['SLOW_REQUEST_THRESHOLD'] = 0
+    app.config['PROFILE_SAMPLE_RATE'] = 1
+    app.config['PROFILE_DIR'] = str(tmpdir)
+    yield str(tmpdir)
+    for key in ['PROFILE_HEADER', 'SLOW_REQUEST_THRESHOLD', 'PROFILE_SAMPLE_RATE', 'PROFILE_DIR']:
+        app.config.pop(key)
+
+@pytest.mark.usefixtures("emptydb")
+def test_unprofiled_request_has_no_timing():
+    with app.test_client() as c:
+        resp = c.get('/schemas')
+        assert 'Server-Timing' not in resp.headers
+
+@pytest.mark.usefixtures("emptydb")
+def test_profiled_request_is_timed_and_logged(profiling, caplog):
+    with app.test_client() as c:
+        create_schema(c, 'test')
+        create_version(c, 'test', 'v1')
+
+        resp = c.get('/schemas/test/1', headers={'X-Profile': '1'})
+        assert resp.data == 'v1'
+
+        phases = [p.split(';')[0] for p in resp.headers['Server-Timing'].split(', ')]
+        assert 'other' in phases
+        assert 'name_to_id' in phases or 'rocksdb_get' in phases
+
+        assert len([r for r in caplog.records if r.name == 'schemaregistry.slow_requests']) == 1
+        assert len([f for f in os.listdir(profiling) if f.endswith('.prof')]) == 1
+
+@pytest.mark.usefixtures("emptydb")
+def test_profiler_is_removed_when_request_raises(profiling):
+    app.config['STORAGE_BACKEND'] = 'unknown'
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    try:
+        with app.test_client() as c:
+            with pytest.raises(Exception):
+                c.get('/schemas', headers={'X-Profile': '1'})
+
+        assert sys.getprofile() is None
+    finally:
+        app.config.pop('STORAGE_BACKEND')
+        app.config.pop('PROPAGATE_EXCEPTIONS')
+
+'''
+/ns/<namespace>/schemas
+'''
+@pytest.fixture()
+def namespaces():
+    app.config['NAMESPACES'] = {'tenant': {'max_schemas': 1, 'max_versions': 1}}
+    yield
+    app.config.pop('NAMESPACES')
+
+@pytest.mark.usefixtures("emptydb", "namespaces")
+def test_namespaces_are_isolated():
+    with app.test_client() as c:
+        create_schema(c, 'test')
+        create_version(c, 'test', 'v1')
+
+        postresp = c.post('/ns/tenant/schemas', data=dict(name='tenant_test'))
+        assert postresp.status_code == 201
+        verresp = c.post('/ns/tenant/schemas/tenant_test', data='tenant v1')
+        assert verresp.status_code == 201
+
+        assert json.loads(c.get('/schemas').data) == ['test']
+        assert json.loads(c.get('/ns/tenant/schemas').data) == ['tenant_test']
+        assert c.get('/ns/tenant/schemas/tenant_test/latest').data == 'tenant v1'
+        assert c.get('/ns/tenant/schemas/test/latest').status_code == 404
+
+@pytest.mark.usefixtures("emptydb", "namespaces")
+def test_namespaces_are_opened_on_startup():
+    startup()
+    assert set(app_module._datastores) == set([None, 'tenant'])
+
+@pytest.mark.usefixtures("emptydb", "namespaces")
+def test_unknown_namespace_returns_404():
+    with app.test_client() as c:
+        resp = c.get('/ns/unknown/schemas')
+        assert resp.status_code == 404
+        assert resp.data == 'Namespace does not exist'
+
+@pytest.mark.usefixtures("emptydb", "namespaces")
+def test_namespace_quotas_are_enforced():
+    with app.test_client() as c:
+        assert c.post('/ns/tenant/schemas', data=dict(name='test')).status_code == 201
+        assert c.post('/ns/tenant/schemas', data=dict(name='test2')).status_code == 403
+
+        assert c.post('/ns/tenant/schemas/test', data='v1').status_code == 201
+        resp = c.post('/ns/tenant/schemas/test', data='v2')
+        assert resp.status_code == 403
+        assert resp.data == 'Quota exceeded'
+
+'''
+GET /schemas?prefix=...&limit=...
+'''
+test_find_schemas_testparams = [
+    ('/schemas?prefix=payments.',           ['payments.auth', 'payments.refund'], 200),
+    ('/schemas?prefix=payments.&limit=1',   ['payments.auth'], 200),
+    ('/schemas?prefix=unknown',             [], 200),
+    ('/schemas?prefix=payments.&limit=abc', None, 400),
+    ('/schemas?prefix=payments.&limit=-1',  None, 400),
+]
+@pytest.mark.usefixtures("emptydb")
+@pytest.mark.parametrize("get_url,retval,status_code", test_find_schemas_testparams)
+def test_find_schemas(get_url, retval, status_code):
+    with app.test_client() as c:
+        for schema in ['payments.refund', 'orders.line', 'payments.auth']:
+            create_schema(c, schema)
+
+        resp = c.get(get_url)
+        assert resp.status_code == status_code
+
+        if retval is not None:
+            assert json.loads(resp.data) == retval
+
+'''
+Rate limiting and load shedding
+'''
+@pytest.fixture()
+def limits():
+    app.config['RATE_LIMITS'] = {'write': (0, 2)}
+    app.config['CONCURRENCY_LIMITS'] = {'list': 0}
+    yield
+    app.config.pop('RATE_LIMITS')
+    app.config.pop('CONCURRENCY_LIMITS')
+
+@pytest.mark.usefixtures("emptydb", "limits")
+def test_writes_are_rate_limited():
+    with app.test_client() as c:
+        create_schema(c, 'test')
+        create_version(c, 'test', 'v1')
+
+        resp = c.post('/schemas/test', data='v2')
+        assert resp.status_code == 429
+        assert 'Retry-After' in resp.headers
+
+        assert c.get('/schemas/test/latest').data == 'v1'
+        assert json.loads(c.get('/stats').data) == {'rejected': {'write.rate_limited': 1}}
+
+@pytest.mark.usefixtures("emptydb", "limits")
+def test_lists_are_shed():
+    with app.test_client() as c:
+        create_schema(c, 'test')
+
+        assert c.get('/schemas').status_code == 503
+        assert c.get('/schemas/test').status_code == 200
+        assert json.loads(c.get('/stats').data) == {'rejected': {'list.shed': 1}}
+
+'''
+Schema size limits
+'''
+@pytest.fixture()
+def max_schema_size():
+    app.config['MAX_SCHEMA_SIZE'] = 200 * 1024
+    yield
+    app.config.pop('MAX_SCHEMA_SIZE')
+
+@pytest.mark.usefixtures("emptydb", "max_schema_size")
+def test_large_schemas():
+    with app.test_client() as c:
+        create_schema(c, 'test')
+
+        schema = 'x' * (150 * 1024)
+        create_version(c, 'test', schema)
+        assert c.get('/schemas/test/latest').data == schema
+        assert c.get('/schemas/test/1').data == schema
+
+        resp = c.post('/schemas/test', data='x' * (250 * 1024))
+        assert resp.status_code == 413
+        assert resp.data == 'Schema too large'
+        assert c.get('/schemas/test').data == '[1]'
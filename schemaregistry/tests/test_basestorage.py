@@ -8,8 +8,10 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import threading
 import pytest
-from schemaregistry.storage.error import SchemaDoesNotExistError, SchemaExistsError, SchemaVersionDoesNotExistError
+from schemaregistry.storage.error import SchemaDoesNotExistError, SchemaExistsError, SchemaVersionDoesNotExistError, \
+    QuotaExceededError
 
 values = {
     'default_schema_name': 'test',
@@ -84,6 +86,10 @@ def test_returns_correct_schema_for_version(storageengine):
     schema = storageengine.get_schema_version(v('default_schema_name'), version_number_2)
     assert v('default_schema_v2') == schema
 
+    ''' Versions from URLs arrive as strings '''
+    schema = storageengine.get_schema_version(v('default_schema_name'), str(version_number_3))
+    assert v('default_schema_v3') == schema
+
 
 def test_throws_error_if_schema_version_requested_for_unknown_schema(storageengine):
     with pytest.raises(SchemaDoesNotExistError):
@@ -126,3 +132,190 @@ def test_reports_created_schema_exists(storageengine):
 def test_reports_missing_schema_does_not_exist(storageengine):
     storageengine.create_schema(v('default_schema_name'))
     assert False == storageengine.schema_exists(v('non_existant_schema'))
+
+
+def test_deleted_schema_is_hidden(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.create_schema(v('additional_schema_name_1'))
+    storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1'))
+    storageengine.delete_schema(v('default_schema_name'))
+
+    assert storageengine.get_schemas() == [v('additional_schema_name_1')]
+    assert False == storageengine.schema_exists(v('default_schema_name'))
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storageengine.get_latest_schema(v('default_schema_name'))
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storageengine.delete_schema(v('default_schema_name'))
+
+
+def test_deleted_schema_name_cannot_be_reused(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.delete_schema(v('default_schema_name'))
+
+    with pytest.raises(SchemaExistsError):
+        storageengine.create_schema(v('default_schema_name'))
+
+
+def test_permanently_deleted_schema_name_can_be_reused_without_reusing_versions(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1'))
+    storageengine.delete_schema(v('default_schema_name'))
+    storageengine.delete_schema(v('default_schema_name'), permanent=True)
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storageengine.delete_schema(v('default_schema_name'), permanent=True)
+
+    storageengine.create_schema(v('default_schema_name'))
+    assert storageengine.get_schema_versions(v('default_schema_name')) == []
+    assert storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v2')) == 2
+    assert storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v3')) == 3
+    assert storageengine.get_schema_versions(v('default_schema_name')) == [2, 3]
+    assert storageengine.get_schema_version(v('default_schema_name'), 2) == v('default_schema_v2')
+
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        storageengine.get_schema_version(v('default_schema_name'), 1)
+
+    storageengine.delete_schema_version(v('default_schema_name'), 2, permanent=True)
+    assert storageengine.get_latest_schema(v('default_schema_name')) == v('default_schema_v3')
+
+    storageengine.delete_schema(v('default_schema_name'), permanent=True)
+    storageengine.create_schema(v('default_schema_name'))
+    assert storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1')) == 4
+
+
+def test_write_racing_permanent_delete_is_rejected(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    schema = storageengine._get_live_schema(v('default_schema_name'))
+    storageengine.delete_schema(v('default_schema_name'), permanent=True)
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storageengine._do_create_schema_version(schema, v('default_schema_v1'))
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storageengine._do_delete_schema_version(schema, 1, False)
+
+
+@pytest.mark.parametrize("permanent", [False, True])
+def test_deleted_version_is_hidden_and_not_reused(storageengine, permanent):
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1'))
+    version_number = storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v2'))
+    storageengine.delete_schema_version(v('default_schema_name'), version_number, permanent=permanent)
+
+    assert storageengine.get_schema_versions(v('default_schema_name')) == [1]
+    assert storageengine.get_latest_schema(v('default_schema_name')) == v('default_schema_v1')
+
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        storageengine.get_schema_version(v('default_schema_name'), version_number)
+
+    assert storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v3')) == version_number + 1
+
+
+def test_delete_non_existant_version_throws(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    version_number = storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1'))
+
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        storageengine.delete_schema_version(v('default_schema_name'), version_number + 1)
+
+    storageengine.delete_schema_version(v('default_schema_name'), version_number)
+
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        storageengine.delete_schema_version(v('default_schema_name'), version_number)
+
+
+def test_quotas_are_enforced(storageengine):
+    storageengine.max_schemas = 1
+    storageengine.max_versions = 1
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v1'))
+
+    with pytest.raises(QuotaExceededError):
+        storageengine.create_schema(v('additional_schema_name_1'))
+
+    with pytest.raises(QuotaExceededError):
+        storageengine.create_schema_version(v('default_schema_name'), v('default_schema_v2'))
+
+
+def test_schema_quota_counts_soft_deleted_schemas_and_concurrent_creates(storageengine):
+    storageengine.max_schemas = 5
+    created = []
+
+    def create(name):
+        try:
+            created.append(storageengine.create_schema(name))
+        except QuotaExceededError:
+            pass
+
+    threads = [threading.Thread(target=create, args=('schema{0}'.format(i),)) for i in xrange(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 5
+    assert len(storageengine.get_schemas()) == 5
+
+    name = storageengine.get_schemas()[0]
+    storageengine.delete_schema(name)
+
+    with pytest.raises(QuotaExceededError):
+        storageengine.create_schema('replacement')
+
+    storageengine.delete_schema(name, permanent=True)
+    storageengine.create_schema('replacement')
+
+    with pytest.raises(QuotaExceededError):
+        storageengine.create_schema('one_too_many')
+
+
+def test_schema_quota_counts_existing_soft_deleted_schemas(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    storageengine.delete_schema(v('default_schema_name'))
+    storageengine.max_schemas = 1
+
+    with pytest.raises(QuotaExceededError):
+        storageengine.create_schema(v('additional_schema_name_1'))
+
+
+def test_version_quota_holds_for_concurrent_creates(storageengine):
+    storageengine.max_versions = 1
+    storageengine.create_schema(v('default_schema_name'))
+    created = []
+
+    def create(version):
+        try:
+            created.append(storageengine.create_schema_version(v('default_schema_name'), version))
+        except QuotaExceededError:
+            pass
+
+    threads = [threading.Thread(target=create, args=('v{0}'.format(i),)) for i in xrange(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert created == [1]
+    assert storageengine.get_schema_versions(v('default_schema_name')) == [1]
+
+
+def test_find_schemas_by_prefix(storageengine):
+    for name in ['payments.refund', 'orders.line', 'payments.auth', 'payments', 'paymentsx', 'payments.capture']:
+        storageengine.create_schema(name)
+
+    storageengine.delete_schema('payments.capture')
+
+    assert storageengine.find_schemas('payments.') == ['payments.auth', 'payments.refund']
+    assert storageengine.find_schemas('payments', limit=3) == ['payments', 'payments.auth', 'payments.refund']
+    assert storageengine.find_schemas('unknown') == []
+
+
+def test_create_and_get_schema_version_as_stream(storageengine):
+    storageengine.create_schema(v('default_schema_name'))
+    version = storageengine.create_schema_version_from_stream(v('default_schema_name'), iter(['{"type": ', '"string"}']))
+
+    assert storageengine.get_schema_version(v('default_schema_name'), version) == '{"type": "string"}'
+    assert ''.join(storageengine.get_schema_version(v('default_schema_name'), version, stream=True)) == '{"type": "string"}'
+    assert ''.join(storageengine.get_latest_schema(v('default_schema_name'), stream=True)) == '{"type": "string"}'
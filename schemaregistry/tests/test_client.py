@@ -0,0 +1,131 @@
+"""
+    tests.client
+    ~~~~~~~~~~~~
+
+    Tests the schema registry client against the app.
+
+    :copyright: (c) 2016 by James Moore.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import threading
+import pytest
+from werkzeug.serving import make_server
+
+from app import app, reinit_db
+from client import SchemaRegistryClient
+from storage.error import SchemaExistsError, SchemaDoesNotExistError, SchemaVersionDoesNotExistError
+
+'''
+TEST FIXTURES
+'''
+@pytest.fixture()
+def server(tmpdir_factory):
+    app.config['ROCKSDB_DATAFILE'] = str(tmpdir_factory.mktemp('schemaregistry', numbered=True))
+    reinit_db()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    server.shutdown()
+
+@pytest.fixture()
+def client(server):
+    client = SchemaRegistryClient(server, latest_ttl=60)
+    yield client
+    client.close()
+
+def test_create_and_get_schema(client):
+    id = client.create_schema('test')
+    version = client.create_schema_version('test', 'v1')
+
+    assert client.get_schemas() == ['test']
+    assert client.get_schemas(id=id) == ['test']
+    assert client.get_schema_versions('test') == [version]
+    assert client.get_schema_version('test', version) == 'v1'
+    assert client.get_latest_schema('test') == 'v1'
+
+def test_errors_are_raised(client):
+    client.create_schema('test')
+    client.create_schema_version('test', 'v1')
+
+    with pytest.raises(SchemaExistsError):
+        client.create_schema('test')
+
+    with pytest.raises(SchemaDoesNotExistError):
+        client.get_latest_schema('non_existant')
+
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        client.get_schema_version('test', 2)
+
+def test_versions_are_cached(client):
+    client.create_schema('test')
+    client.create_schema_version('test', 'v1')
+    assert client.get_schema_version('test', 1) == 'v1'
+    assert client.get_latest_schema('test') == 'v1'
+
+    reinit_db()
+    app.config['STORAGE_BACKEND'] = 'memory'
+    try:
+        assert client.get_schema_version('test', 1) == 'v1'
+        assert client.get_latest_schema('test') == 'v1'
+    finally:
+        app.config.pop('STORAGE_BACKEND')
+
+def test_new_version_is_seen_as_latest(client):
+    client.create_schema('test')
+    client.create_schema_version('test', 'v1')
+    assert client.get_latest_schema('test') == 'v1'
+
+    client.create_schema_version('test', 'v2')
+    assert client.get_latest_schema('test') == 'v2'
+
+def test_versions_are_cached_on_disk(server, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    client = SchemaRegistryClient(server, cache_dir=cache_dir)
+    client.create_schema('test')
+    client.create_schema_version('test', 'v1')
+    assert client.get_schema_version('test', 1) == 'v1'
+    client.close()
+
+    client.delete_schema('test', permanent=True)
+    client.create_schema('test')
+    assert client.create_schema_version('test', 'v2') == 2
+
+    client = SchemaRegistryClient(server, cache_dir=cache_dir)
+    assert client.get_schema_version('test', 1) == 'v1'
+    assert client.get_schema_version('test', 2) == 'v2'
+    client.close()
+
+def test_disk_cache_is_keyed_by_url(server, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    app.config['NAMESPACES'] = {'tenant': {}}
+    try:
+        client = SchemaRegistryClient(server, cache_dir=cache_dir)
+        client.create_schema('test')
+        client.create_schema_version('test', 'v1')
+        assert client.get_schema_version('test', 1) == 'v1'
+        client.close()
+
+        client = SchemaRegistryClient(server + '/ns/tenant', cache_dir=cache_dir)
+        client.create_schema('test')
+        client.create_schema_version('test', 'tenant v1')
+        assert client.get_schema_version('test', 1) == 'tenant v1'
+        client.close()
+    finally:
+        app.config.pop('NAMESPACES')
+
+def test_idle_connections_are_not_reused(server):
+    client = SchemaRegistryClient(server, idle_timeout=0.05)
+    client.create_schema('test')
+    idle_connection = client._SchemaRegistryClient__pool.queue[0][0]
+    time.sleep(0.1)
+
+    client.create_schema_version('test', 'v1')
+    assert idle_connection.sock is None
+    assert client._SchemaRegistryClient__pool.queue[0][0] is not idle_connection
+    client.close()
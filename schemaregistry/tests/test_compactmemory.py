@@ -0,0 +1,76 @@
+"""
+    tests.compactmemory
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tests the CompactMemory Storage container.
+
+    :copyright: (c) 2016 by James Moore.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import pytest
+from schemaregistry.storage.compactmemory import CompactMemory
+from schemaregistry.storage.error import SchemaDoesNotExistError
+
+def test_snapshot_is_reloaded(tmpdir):
+    snapshot_file = str(tmpdir.join('schemas.snapshot'))
+
+    storage = CompactMemory(snapshot_file)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+    storage.snapshot()
+
+    storage = CompactMemory(snapshot_file)
+    assert storage.get_schemas() == ['test']
+    assert storage.get_schema_versions('test') == [1, 2]
+    assert storage.get_latest_schema('test') == 'v2'
+
+def test_memory_footprint_counts_schemas_and_versions():
+    storage = CompactMemory()
+    storage.create_schema('test')
+    storage.create_schema('test2')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+
+    footprint = storage.memory_footprint()
+    assert footprint['schemas'] == 2
+    assert footprint['versions'] == 2
+    assert footprint['index_bytes'] > 0
+    assert footprint['body_bytes'] > 0
+
+def test_get_schemas_filters_on_hex_id():
+    storage = CompactMemory()
+    id = storage.create_schema('test')
+    storage.create_schema('test2')
+
+    assert storage.get_schemas(ids=[id]) == ['test']
+    assert storage.get_schemas(ids=['Unknown']) == []
+
+def test_version_numbers_are_not_reused_after_reload(tmpdir):
+    snapshot_file = str(tmpdir.join('schemas.snapshot'))
+
+    storage = CompactMemory(snapshot_file)
+    storage.create_schema('test')
+    storage.create_schema('deleted')
+    storage.create_schema_version('deleted', 'v1')
+    storage.delete_schema('deleted', permanent=True)
+    storage.snapshot()
+
+    storage = CompactMemory(snapshot_file)
+    storage.create_schema('deleted')
+    assert storage.create_schema_version('deleted', 'v2') == 2
+    assert storage.create_schema_version('test', 'v1') == 1
+
+def test_write_racing_permanent_delete_is_rejected():
+    storage = CompactMemory()
+    storage.create_schema('a')
+    schema = storage._get_live_schema('a')
+    storage.delete_schema('a', permanent=True)
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storage._do_create_schema_version(schema, 'v1')
+
+    storage.create_schema('a')
+    assert storage.get_schema_versions('a') == []
+    assert storage.create_schema_version('a', 'v1') == 1
@@ -0,0 +1,148 @@
+"""
+    tests.mmaplog
+    ~~~~~~~~~~~~~
+
+    Tests the MMapLog Storage container.
+
+    :copyright: (c) 2016 by James Moore.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import pytest
+from schemaregistry.storage.mmaplog import MMapLog
+from schemaregistry.storage.error import SchemaDoesNotExistError, StoreIsReadOnlyError
+
+@pytest.fixture
+def logfile(tmpdir):
+    return str(tmpdir.join('schemas.log'))
+
+def test_reopened_log_contains_schemas_and_versions(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+    storage.close()
+
+    storage = MMapLog(logfile, read_only=True)
+    assert storage.get_schemas() == ['test']
+    assert storage.get_schema_versions('test') == [1, 2]
+    assert storage.get_latest_schema('test') == 'v2'
+
+def test_torn_record_at_tail_is_discarded(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+    storage.close()
+
+    with open(logfile, 'r+b') as f:
+        f.seek(-1, 2)
+        f.truncate()
+
+    storage = MMapLog(logfile)
+    assert storage.get_schema_versions('test') == [1]
+
+    version = storage.create_schema_version('test', 'v2')
+    assert version == 2
+    assert storage.get_schema_version('test', version) == 'v2'
+
+def test_zero_copy_returns_buffer(logfile):
+    storage = MMapLog(logfile, zero_copy=True)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+
+    schema = storage.get_schema_version('test', 1)
+    assert isinstance(schema, buffer)
+    assert str(schema) == 'v1'
+
+def test_read_only_log_cannot_be_written(logfile):
+    MMapLog(logfile).close()
+    storage = MMapLog(logfile, read_only=True)
+
+    with pytest.raises(StoreIsReadOnlyError):
+        storage.create_schema('test')
+
+def test_deletes_survive_reopen(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema('test2')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+    storage.delete_schema_version('test', 1, permanent=True)
+    storage.delete_schema('test2')
+    storage.close()
+
+    storage = MMapLog(logfile)
+    assert storage.get_schemas() == ['test']
+    assert storage.get_schema_versions('test') == [2]
+    assert storage.schema_exists('test2') == False
+
+def test_write_racing_permanent_delete_is_rejected(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('a')
+    schema = storage._get_live_schema('a')
+    storage.delete_schema('a', permanent=True)
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storage._do_create_schema_version(schema, 'v1')
+
+def test_records_for_unknown_schemas_are_skipped(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('a')
+    storage._MMapLog__append(MMapLog.RECORD_VERSION, 'unknown', 'v1')
+    storage.create_schema_version('a', 'v1')
+    storage.create_schema('b')
+    storage.close()
+
+    storage = MMapLog(logfile)
+    assert sorted(storage.get_schemas()) == ['a', 'b']
+    assert storage.get_latest_schema('a') == 'v1'
+
+def test_version_numbers_are_not_reused_after_reopen(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.delete_schema('test', permanent=True)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v2')
+    storage.delete_schema_version('test', 2, permanent=True)
+    storage.create_schema_version('test', 'v3')
+    storage.close()
+
+    storage = MMapLog(logfile)
+    assert storage.get_schema_versions('test') == [3]
+    assert storage.get_latest_schema('test') == 'v3'
+
+def test_checkpoint_is_used_and_later_records_scanned(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.close()
+
+    ''' Records covered by the checkpoint are not checked again '''
+    with open(logfile, 'r+b') as f:
+        f.seek(MMapLog.HEADER.size)
+        f.write(b'X')
+
+    storage = MMapLog(logfile)
+    assert storage.get_latest_schema('test') == 'v1'
+    storage.create_schema_version('test', 'v2')
+    storage.create_schema('test2')
+
+    storage = MMapLog(logfile, read_only=True)
+    assert sorted(storage.get_schemas()) == ['test', 'test2']
+    assert storage.get_schema_versions('test') == [1, 2]
+
+def test_checkpoint_not_matching_log_is_ignored(logfile):
+    storage = MMapLog(logfile)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+    storage.close()
+
+    with open(logfile, 'r+b') as f:
+        f.seek(-1, 2)
+        f.truncate()
+
+    storage = MMapLog(logfile)
+    assert storage.get_schema_versions('test') == [1]
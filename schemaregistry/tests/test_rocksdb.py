@@ -0,0 +1,141 @@
+"""
+    tests.rocksdb
+    ~~~~~~~~~~~~~
+
+    Tests the RocksDB Storage container.
+
+    :copyright: (c) 2016 by James Moore.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import zlib
+import pytest
+from schemaregistry.storage.rocksdb import RocksDB
+from schemaregistry.storage.error import KeyFormatMismatchError, SchemaDoesNotExistError, SchemaTooLargeError, \
+    SchemaVersionDoesNotExistError, SchemaVersionCorruptError
+
+@pytest.fixture
+def datafile(tmpdir_factory):
+    return str(tmpdir_factory.mktemp('schemaregistry', numbered=True))
+
+def test_cannot_open_hex_store_with_raw_ids(datafile):
+    storage = RocksDB(datafile)
+    storage.create_schema('test')
+    del storage
+
+    with pytest.raises(KeyFormatMismatchError):
+        RocksDB(datafile, raw_ids=True)
+
+def test_migrate_to_raw_ids(datafile):
+    storage = RocksDB(datafile)
+    id = storage.create_schema('test')
+    storage.create_schema('test2')
+    storage.create_schema_version('test', 'v1')
+    storage.create_schema_version('test', 'v2')
+
+    storage.migrate_to_raw_ids()
+    del storage
+
+    storage = RocksDB(datafile, raw_ids=True)
+    assert set(storage.get_schemas()) == set(['test', 'test2'])
+    assert storage.get_schemas(ids=[id]) == ['test']
+    assert storage.get_schema_versions('test') == [1, 2]
+    assert storage.get_schema_version('test', 1) == 'v1'
+    assert storage.get_latest_schema('test') == 'v2'
+    assert storage.create_schema_version('test', 'v3') == 3
+
+def test_collect_garbage_removes_unreferenced_versions(datafile):
+    storage = RocksDB(datafile)
+    id = storage.create_schema('test')
+    storage.create_schema_version('test', 'v1')
+
+    orphan_key = b'{0}.{1}'.format(id, 'x' * 32)
+    storage._RocksDB__db.put(orphan_key, 'orphan')
+
+    assert storage.collect_garbage() == 1
+    assert storage._RocksDB__db.get(orphan_key) is None
+    assert storage.get_latest_schema('test') == 'v1'
+    assert storage.collect_garbage() == 0
+
+def test_name_index_is_built_for_existing_store(datafile):
+    storage = RocksDB(datafile)
+    storage.create_schema('payments.auth')
+    storage.create_schema('orders.line')
+
+    db = storage._RocksDB__db
+    iterator = db.iterkeys()
+    iterator.seek_to_first()
+    for key in [k for k in iterator if k.startswith(b'_name')]:
+        db.delete(key)
+    del storage
+
+    storage = RocksDB(datafile)
+    assert storage.find_schemas('payments.') == ['payments.auth']
+
+def test_large_versions_are_chunked(datafile):
+    storage = RocksDB(datafile, chunk_size=4)
+    storage.create_schema('test')
+    storage.create_schema_version('test', 'small')
+    storage.create_schema_version_from_stream('test', iter(['0123456', '789', 'abcdef']))
+    storage.create_schema_version('test', 'x' * 10)
+
+    assert storage.get_schema_version('test', 2) == '0123456789abcdef'
+    assert list(storage.get_schema_version('test', 2, stream=True)) == ['0123', '4567', '89ab', 'cdef']
+    assert storage.get_latest_schema('test') == 'x' * 10
+    assert storage.collect_garbage() == 0
+
+    version_key = storage._RocksDB__get_version_list(storage._name_to_id('test'))[1]
+    storage.delete_schema_version('test', 2, permanent=True)
+
+    iterator = storage._RocksDB__db.iterkeys()
+    iterator.seek_to_first()
+    assert [k for k in iterator if k.startswith(version_key)] == []
+    assert storage.get_schema_version('test', 1) == 'small'
+
+def test_write_racing_permanent_delete_is_rejected(datafile):
+    storage = RocksDB(datafile)
+    storage.create_schema('test')
+    schema = storage._get_live_schema('test')
+    storage.delete_schema('test', permanent=True)
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storage._do_create_schema_version(schema, 'v1')
+
+    with pytest.raises(SchemaDoesNotExistError):
+        storage._do_delete_schema_version(schema, 1, False)
+
+    assert storage.get_schemas() == []
+    storage.create_schema('test')
+    assert storage.get_schema_versions('test') == []
+
+def test_chunks_are_removed_if_stream_fails(datafile):
+    storage = RocksDB(datafile, chunk_size=4)
+    storage.create_schema('test')
+
+    def chunks():
+        yield '0123456789ab'
+        raise SchemaTooLargeError()
+
+    with pytest.raises(SchemaTooLargeError):
+        storage.create_schema_version_from_stream('test', chunks())
+
+    assert storage.get_schema_versions('test') == []
+    assert storage.collect_garbage() == 0
+
+def test_chunks_are_checked_when_read(datafile):
+    storage = RocksDB(datafile, chunk_size=4)
+    storage.create_schema('test')
+    storage.create_schema_version('test', '0123456789ab')
+    version_key = storage._RocksDB__get_version_list(storage._name_to_id('test'))[0]
+    db = storage._RocksDB__db
+
+    db.put(version_key + '.00000002', zlib.compress('89aX'))
+    chunks = storage.get_schema_version('test', 1, stream=True)
+    assert next(chunks) == '0123'
+    assert next(chunks) == '4567'
+    with pytest.raises(SchemaVersionCorruptError):
+        next(chunks)
+
+    db.delete(version_key + '.00000001')
+    with pytest.raises(SchemaVersionDoesNotExistError):
+        storage.get_schema_version('test', 1)